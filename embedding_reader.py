@@ -0,0 +1,83 @@
+# Reading exported embeddings with NumPy only.
+# export_embeddings in sgns_implementation.py writes the target embeddings as three files:
+# - path.vectors.npy: the embeddings (float32 or float16)
+# - path.norms.npy: the length of each embedding (float32)
+# - path.vocab: the words, one per line, in the same order as the rows
+# This module doesn't depend on PyTorch, so inference processes can import it without the training code.
+# For the same reason, it has its own copy of merge_topk from sgns_implementation.py.
+
+import numpy as np
+
+def merge_topk(values, ids, new_values, new_ids, k):
+    # Merges two lists of (score, id) for each row, and keeps the k highest scores, sorted.
+    # new_ids contains the ids of the columns of new_values.
+    if new_values.shape[1] > k:
+        top = np.argpartition(-new_values, k-1, axis=1)[:, :k]
+        new_values = np.take_along_axis(new_values, top, axis=1)
+        new_ids = new_ids[top]
+    else:
+        new_ids = np.broadcast_to(new_ids, new_values.shape)
+    values = np.concatenate([values, new_values], axis=1)
+    ids = np.concatenate([ids, new_ids], axis=1)
+    if values.shape[1] > k:
+        top = np.argpartition(-values, k-1, axis=1)[:, :k]
+        values = np.take_along_axis(values, top, axis=1)
+        ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    return np.take_along_axis(values, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+class EmbeddingReader:
+
+    def __init__(self, path):
+        self.vectors = np.load(path + '.vectors.npy', mmap_mode='r')
+        self.norms = np.load(path + '.norms.npy', mmap_mode='r')
+        self.vocab_file = path + '.vocab'
+        self.block_size = 1<<16
+        self._words = None
+        self._voc = None
+
+    @property
+    def words(self):
+        # The vocabulary is read when it's first needed.
+        if self._words is None:
+            with open(self.vocab_file, encoding='utf-8') as f:
+                self._words = f.read().split('\n')[:len(self.vectors)]
+        return self._words
+
+    @property
+    def voc(self):
+        if self._voc is None:
+            self._voc = dict(zip(self.words, range(len(self.words))))
+        return self._voc
+
+    def vector(self, word):
+        return np.array(self.vectors[self.voc[word]], dtype=np.float32)
+
+    def normalized(self, ix):
+        norms = np.maximum(self.norms[ix], 1e-12)
+        return self.vectors[ix].astype(np.float32) / norms[:, None]
+
+    def search(self, queries, k):
+        # Finds the k highest-scoring words for each (normalized) query. Returns arrays
+        # of scores and word indices, each of shape (nbr of queries, k).
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self.vectors))
+        values = np.zeros((len(queries), 0), dtype=np.float32)
+        ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.vectors), self.block_size):
+            block = self.vectors[start:start+self.block_size].astype(np.float32)
+            scores = (queries @ block.T) / np.maximum(self.norms[start:start+len(block)], 1e-12)
+            values, ids = merge_topk(values, ids, scores, np.arange(start, start+len(block)), k)
+        return values, ids
+
+    def nearest_neighbors(self, words, n_neighbors):
+        # As in SGNSModel, we find n_neighbors+1 words and skip the top one, which is normally the word itself.
+        values, ids = self.search(self.normalized([ self.voc[w] for w in words ]), n_neighbors+1)
+        return [ [ (self.words[ix], float(val)) for ix, val in zip(ixs[1:], vals[1:]) ] for ixs, vals in zip(ids, values) ]
+
+    def cosine_similarity(self, word1, word2):
+        v1, v2 = self.normalized([self.voc[word1], self.voc[word2]])
+        return float(v1.dot(v2))
+
+    def nbytes(self):
+        return self.vectors.nbytes + self.norms.nbytes
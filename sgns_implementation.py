@@ -12,8 +12,21 @@ import torch.nn as nn
 
 import numpy as np
 
-import sys, time, os
-from collections import Counter
+import sys, time, os, copy, hashlib, locale, struct, zlib
+import queue as queue_module
+import asyncio, concurrent.futures, json, http, http.client
+import multiprocessing, contextlib, threading, traceback
+from collections import Counter, deque
+from multiprocessing import shared_memory
+from itertools import chain, islice, repeat
+
+# The reader for exported embeddings is in a separate module, which doesn't need PyTorch.
+# It's only needed to read embeddings exported with export_embeddings, so the notebook also
+# runs without that file.
+try:
+    from embedding_reader import EmbeddingReader
+except ImportError:
+    EmbeddingReader = None
 
 !rm -rf wikipedia* *.zip*
 !wget http://www.cse.chalmers.se/~richajo/dit865/slask/files/wikipedia_small.zip
@@ -34,19 +47,24 @@ def make_ns_table(params):
     print('Building vocabulary and sampling table...')    
 
     # First, build a full frequency table from the whole corpus.
-    with open(corpus) as f:
-        for i, line in enumerate(f, 1):
-            if lowercase:
-                line = line.lower()
-            freqs.update(line.split())
-            if i % 50000 == 0:
-                sys.stdout.write('.')
-                sys.stdout.flush()
-            if i % 1000000 == 0:
-                sys.stdout.write(' ')
-                sys.stdout.write(str(i))
-                sys.stdout.write('\n')
-                sys.stdout.flush()
+    # If we have several workers, each of them counts a part of the file.
+    workers = params.get('workers', 1)
+    if workers > 1:
+        freqs = count_words_parallel(corpus, lowercase, workers)
+    else:
+        with open(corpus) as f:
+            for i, line in enumerate(f, 1):
+                if lowercase:
+                    line = line.lower()
+                freqs.update(line.split())
+                if i % 50000 == 0:
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
+                if i % 1000000 == 0:
+                    sys.stdout.write(' ')
+                    sys.stdout.write(str(i))
+                    sys.stdout.write('\n')
+                    sys.stdout.flush()
     print()
 
     # Sort the frequencies, then select the most frequent words as the vocabulary.
@@ -80,6 +98,65 @@ def make_ns_table(params):
     scaler = ns_table_size / sum_freq
     return [(w, freq, int(round(ns_table[w]*scaler))) for w, freq in freqs_sorted]
 
+def line_aligned_shards(filename, n_shards):
+    # Splits a file into byte ranges of roughly equal size, where each range
+    # starts at the beginning of a line.
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, n_shards):
+            # Move to the start of the first line that begins at this position or later.
+            pos = max(size * i // n_shards, bounds[-1])
+            if pos > 0:
+                f.seek(pos - 1)
+                f.readline()
+                pos = f.tell()
+            bounds.append(min(pos, size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def read_lines_with_offsets(filename, start, end):
+    # Yields the lines in a byte range of a file, decoded in the same way as when
+    # we open the file in text mode, together with the byte offset where each line starts.
+    encoding = locale.getpreferredencoding(False)
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            yield pos, line.decode(encoding)
+            pos += len(line)
+
+def read_shard_lines(filename, start, end):
+    # Yields the lines in a byte range of a file.
+    for _, line in read_lines_with_offsets(filename, start, end):
+        yield line
+
+def count_words_shard(args):
+    # Counts the words in one shard of the corpus. This runs in a worker process.
+    corpus, start, end, lowercase = args
+    freqs = Counter()
+    for line in read_shard_lines(corpus, start, end):
+        if lowercase:
+            line = line.lower()
+        freqs.update(line.split())
+    return freqs
+
+def count_words_parallel(corpus, lowercase, workers):
+    # Splits the corpus into line-aligned shards, counts them in worker processes,
+    # and merges the counts. We use more shards than workers to balance the load.
+    # We fork the workers, so that they can use functions defined in a notebook.
+    shards = line_aligned_shards(corpus, 4 * workers)
+    freqs = Counter()
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        jobs = [(corpus, start, end, lowercase) for start, end in shards]
+        for i, shard_freqs in enumerate(pool.imap_unordered(count_words_shard, jobs), 1):
+            freqs.update(shard_freqs)
+            sys.stdout.write(f'\rCounted {i}/{len(shards)} shards.')
+            sys.stdout.flush()
+    return freqs
+
 def load_ns_table(filename):
     with open(filename) as f:
         out = []
@@ -93,6 +170,225 @@ def save_ns_table(table, filename):
         for w, fr, ns in table:
             print(f'{w} {fr} {ns}', file=f)
 
+# Negative sampling with the alias method.
+# The classic word2vec approach is to expand the sampling distribution into a huge table where
+# each word occurs a number of times proportional to its probability, and then draw uniform
+# positions from that table. With 1<<24 positions this takes a lot of memory and startup time.
+# Walker's alias method (here in Vose's formulation) instead stores two arrays of vocabulary size:
+# for each column k, a probability prob[k] of keeping k, and an alias[k] to use otherwise.
+# A sample then costs one uniform integer, one uniform float and one comparison.
+
+# A binary format for the negative sampling table.
+# The text format needs to be parsed line by line, which is slow for large vocabularies.
+# The binary file consists of a header, followed by four sections (each starting at a multiple of 8 bytes):
+# - the byte offsets of the words in the string arena (int64, number of words + 1)
+# - the word frequencies (int64)
+# - the negative sampling counts (int32)
+# - the string arena: the UTF-8 encoded words, separated by newlines
+# The header stores a magic string, the number of words, the size of the arena, and a CRC32 checksum of the sections.
+
+NS_TABLE_MAGIC = b'SGNSVOC1'
+NS_TABLE_HEADER = struct.Struct('<8sqqI4x')
+
+def ns_table_sections(n_words, arena_size):
+    # Computes the (offset, size) of each section in the binary file.
+    def align(n):
+        return (n + 7) // 8 * 8
+    pos = NS_TABLE_HEADER.size
+    sections = []
+    for size in [8*(n_words+1), 8*n_words, 4*n_words, arena_size]:
+        sections.append((pos, size))
+        pos = align(pos + size)
+    return sections
+
+def save_ns_table_binary(table, filename):
+    words, freqs, counts = ns_table_arrays(table)
+    arena = '\n'.join(words).encode('utf-8')
+    lengths = np.array([len(w.encode('utf-8')) for w in words], dtype=np.int64)
+    offsets = np.zeros(len(words)+1, dtype=np.int64)
+    # Each word is followed by a separator.
+    offsets[1:] = np.cumsum(lengths + 1)
+
+    payloads = [offsets.tobytes(), freqs.astype(np.int64).tobytes(), counts.astype(np.int32).tobytes(), arena]
+    sections = ns_table_sections(len(words), len(arena))
+    checksum = 0
+    for data in payloads:
+        checksum = zlib.crc32(data, checksum)
+
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(NS_TABLE_HEADER.pack(NS_TABLE_MAGIC, len(words), len(arena), checksum))
+        for (pos, _), data in zip(sections, payloads):
+            f.write(b'\0' * (pos - f.tell()))
+            f.write(data)
+    os.replace(filename + '.tmp', filename)
+
+def load_ns_table_binary(filename, verify=True):
+    return NSTableFile(filename, verify)
+
+class NSTableFile:
+
+    # A memory-mapped binary negative sampling table. It can be used in the same way
+    # as the list of (word, frequency, sample count) tuples we get from make_ns_table,
+    # but it also gives direct access to the arrays.
+
+    def __init__(self, filename, verify=True):
+        self.filename = filename
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        if len(self.data) < NS_TABLE_HEADER.size:
+            raise ValueError(f'{filename} is not a binary negative sampling table')
+        magic, n_words, arena_size, checksum = NS_TABLE_HEADER.unpack(bytes(self.data[:NS_TABLE_HEADER.size]))
+        if magic != NS_TABLE_MAGIC:
+            raise ValueError(f'{filename} is not a binary negative sampling table')
+        sections = ns_table_sections(n_words, arena_size)
+        if verify:
+            found = 0
+            for pos, size in sections:
+                found = zlib.crc32(self.data[pos:pos+size], found)
+            if found != checksum:
+                raise ValueError(f'Checksum error in {filename}')
+
+        (o_pos, _), (f_pos, _), (c_pos, _), (a_pos, a_size) = sections
+        self.offsets = np.frombuffer(self.data, dtype=np.int64, count=n_words+1, offset=o_pos)
+        self.freqs = np.frombuffer(self.data, dtype=np.int64, count=n_words, offset=f_pos)
+        self.counts = np.frombuffer(self.data, dtype=np.int32, count=n_words, offset=c_pos)
+        self.arena = self.data[a_pos:a_pos+a_size]
+        self._words = None
+
+    @property
+    def words(self):
+        # The words are decoded all at once when they are first needed.
+        if self._words is None:
+            self._words = bytes(self.arena).decode('utf-8').split('\n') if len(self.arena) else []
+        return self._words
+
+    def word(self, i):
+        # Decodes a single word, using the offsets, without decoding the whole arena.
+        if self._words is not None:
+            return self._words[i]
+        # Each word is followed by a separator (except the last one, where the arena ends).
+        return bytes(self.arena[self.offsets[i]:self.offsets[i+1]-1]).decode('utf-8')
+
+    def __len__(self):
+        return len(self.freqs)
+
+    def __getitem__(self, i):
+        return self.word(i), int(self.freqs[i]), int(self.counts[i])
+
+    def __iter__(self):
+        return zip(self.words, self.freqs.tolist(), self.counts.tolist())
+
+    def voc(self):
+        # The string-to-integer mapping for the vocabulary.
+        return dict(zip(self.words, range(len(self))))
+
+    def prune_probs(self, prune_threshold):
+        # The subsampling probabilities as in Mikolov's paper, indexed by word id.
+        return 1 - np.sqrt(prune_threshold * self.freqs.sum() / self.freqs)
+
+    def sampler(self, ns_exp=None):
+        return AliasSampler(self, ns_exp)
+
+    def export_text(self, filename):
+        save_ns_table(self, filename)
+
+def ns_table_arrays(ns_table):
+    # Returns the words, frequencies and sample counts of a negative sampling table,
+    # which can be either a list of tuples or a binary table.
+    if isinstance(ns_table, NSTableFile):
+        return ns_table.words, ns_table.freqs, ns_table.counts
+    words = [w for w, _, _ in ns_table]
+    freqs = np.array([f for _, f, _ in ns_table], dtype=np.int64)
+    counts = np.array([c for _, _, c in ns_table], dtype=np.int64)
+    return words, freqs, counts
+
+class AliasSampler:
+
+    def __init__(self, ns_table, ns_exp=None):
+        # If an exponent is given, we compute the smoothed distribution from the raw frequencies,
+        # so that the precision does not depend on the table size. Otherwise, we use the
+        # integer sample counts stored in the table.
+        _, freqs, counts = ns_table_arrays(ns_table)
+        if ns_exp is not None:
+            weights = freqs.astype(np.float64) ** ns_exp
+        else:
+            weights = counts.astype(np.float64)
+        n = len(weights)
+
+        # Scale so that the average column has probability mass 1.
+        scaled = weights * (n / weights.sum())
+        prob = np.ones(n, dtype=np.float64)
+        alias = np.arange(n, dtype=np.int64)
+
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        scaled = scaled.tolist()
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            # Column s is filled up with the remaining mass from l.
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Whatever is left over should have probability 1 (up to rounding errors).
+
+        self.voc_size = n
+        self.prob = torch.as_tensor(prob)
+        self.alias = torch.as_tensor(alias)
+
+    def sample(self, shape):
+        # Pick a column uniformly, then either keep it or use its alias.
+        # We use a single uniform number for both decisions: the integer part selects
+        # the column, and the fractional part is compared to the column's probability.
+        u = torch.rand(shape, dtype=torch.double) * self.voc_size
+        cols = u.long()
+        keep = (u - cols) < self.prob.take(cols)
+        return torch.where(keep, cols, self.alias.take(cols))
+
+def make_expanded_ns_table(ns_table):
+    # The old-style negative sampling table: each word id repeated as many times as
+    # given by its sample count.
+    _, _, counts = ns_table_arrays(ns_table)
+    return torch.as_tensor(np.repeat(np.arange(len(ns_table)), counts))
+
+def current_rss_mb():
+    # The resident set size of this process, in megabytes.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1<<20)
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def benchmark_ns_samplers(ns_table, params, n_batches=20):
+    # Compares the expanded table to the alias sampler: build time, memory and sampling speed.
+    shape = (params['batch-size'], params['n-neg-samples'])
+    n_samples = n_batches * shape[0] * shape[1]
+    
+    rss0 = current_rss_mb()
+    t0 = time.time()
+    table = make_expanded_ns_table(ns_table)
+    t1 = time.time()
+    rss1 = current_rss_mb()
+    for _ in range(n_batches):
+        table.take(torch.randint(len(table), shape))
+    t2 = time.time()
+    print(f'Expanded table: build {t1-t0:.3f} s, RSS +{rss1-rss0:.1f} MB, {n_samples/(t2-t1):.0f} samples/sec')
+    del table
+
+    rss0 = current_rss_mb()
+    t0 = time.time()
+    sampler = AliasSampler(ns_table, params.get('ns-exp'))
+    t1 = time.time()
+    rss1 = current_rss_mb()
+    for _ in range(n_batches):
+        sampler.sample(shape)
+    t2 = time.time()
+    print(f'Alias sampler: build {t1-t0:.3f} s, RSS +{rss1-rss0:.1f} MB, {n_samples/(t2-t1):.0f} samples/sec')
+
 class SGNSContextGenerator:
 
     def __init__(self, ns_table, params):
@@ -101,7 +397,8 @@ class SGNSContextGenerator:
         self.corpus = params['corpus']
         
         # The string-to-integer mapping for the vocabulary.
-        self.voc = { w:i for i, (w, _, _ ) in enumerate(ns_table) }
+        words, freqs, _ = ns_table_arrays(ns_table)
+        self.voc = dict(zip(words, range(len(words))))
 
         # The number of positive instances we'll create in each batch.
         self.batch_size = params['batch-size']
@@ -113,42 +410,123 @@ class SGNSContextGenerator:
         self.lowercase = params['lowercase']
         
         self.word_count = 0
+
+        # Whether we should generate the pairs with NumPy array operations instead of
+        # Python loops, and how many lines we process at a time in that case.
+        self.vectorized = params.get('vectorized-pairs', False)
+        self.chunk_lines = params.get('chunk-lines', 10000)
+
+        # If we're training with several processes, each of them reads a shard of the corpus.
+        self.shard = None
+
+        # Timings of the processing stages. The trainer replaces this with its own metrics object.
+        self.metrics = TrainingMetrics()
+
+        # Where the next call to batches should continue, if we resume training from a checkpoint.
+        self.start_state = None
+
+        # For each batch we yield, we record where to continue after that batch: a position in the corpus
+        # (a byte offset, or a line number in the encoded corpus), the number of words before that position,
+        # and the number of pairs generated from that position that were already used.
+        # The trainer takes the positions from the front as it uses the batches.
+        self.positions = deque()
         
         # We define the pruning probabilities for each word as in Mikolov's paper.
-        total_freq = sum(f for _, f, _ in ns_table)
-        self.prune_probs = {}
-        for w, f, _ in ns_table:
-            self.prune_probs[w] = 1 - np.sqrt(params['prune-threshold'] * total_freq / f)
-
-    def prune(self, tokens):
-        ps = np.random.random(size=len(tokens))
-        # Remove some words from the input with probabilities defined by their frequencies.
-        return [ w for w, p in zip(tokens, ps) if p >= self.prune_probs.get(w, 0) ]
+        # They are stored in an array indexed by word id. The extra last position stands
+        # for out-of-vocabulary words, which are never pruned.
+        total_freq = int(freqs.sum())
+        self.prune_probs = np.zeros(len(words)+1, dtype=np.float32)
+        self.prune_probs[:-1] = 1 - np.sqrt(params['prune-threshold'] * total_freq / freqs)
+
+        # Random numbers for pruning are taken from a pool, which we refill when it runs out.
+        self.random_pool_size = params.get('random-pool-size', 1<<20)
+        self.random_pool = np.zeros(0, dtype=np.float32)
+        self.random_pool_pos = 0
+
+        # Where to store the encoded corpus (or None if we always read the text).
+        self.cache_dir = params.get('corpus-cache')
+        if self.cache_dir:
+            self.cache_key = corpus_cache_key(self.corpus, ns_table, self.lowercase)
+
+        # Whether the positions we record are line numbers in the encoded corpus or byte offsets in the text.
+        self.position_mode = 'line' if self.cache_dir else 'byte'
+
+    def encode(self, tokens):
+        # Encodes a list of tokens as integers. Out-of-vocabulary words get the id
+        # equal to the vocabulary size until they have been pruned.
+        return np.fromiter(map(self.voc.get, tokens, repeat(len(self.voc))), dtype=np.int32, count=len(tokens))
+
+    def random_numbers(self, n):
+        # Returns n uniform random numbers from the pool.
+        if self.random_pool_pos + n > len(self.random_pool):
+            self.random_pool = np.random.random(size=max(self.random_pool_size, n)).astype(np.float32)
+            self.random_pool_pos = 0
+        ps = self.random_pool[self.random_pool_pos:self.random_pool_pos+n]
+        self.random_pool_pos += n
+        return ps
+
+    def prune(self, ids):
+        # Remove some words from the input with probabilities defined by their frequencies,
+        # then map out-of-vocabulary words to the dummy token.
+        # Returns the remaining ids and the mask of the positions we kept.
+        with self.metrics.timer('subsample'):
+            keep = self.random_numbers(len(ids)) >= self.prune_probs[ids]
+            ids = ids[keep]
+            ids[ids == len(self.voc)] = 0
+        return ids, keep
 
     def batches(self):
 
+        # Start with a fresh pool of random numbers, in case the random seed has been set.
+        self.random_pool = np.zeros(0, dtype=np.float32)
+
+        # Start from the beginning, unless we continue from a checkpoint.
+        self.start_position, self.word_count, self.skip_pairs = self.start_state or (None, 0, 0)
+        self.start_state = None
+        self.positions.clear()
+
+        if self.cache_dir:
+            yield from self.batches_cached()
+            return
+
+        if self.vectorized:
+            yield from self.batches_vectorized()
+            return
+
         widths = np.random.randint(1, self.ctx_width+1, size=self.batch_size)
         width_ix = 0
 
-        self.word_count = 0
+        # If we continue from a checkpoint, we skip the pairs of the first line that were already used.
+        skip = self.skip_pairs
         
-        with open(self.corpus) as f:
+        with self.open_corpus(self.start_position) as f:
             out_t = []
             out_c = []
-            for line in f:
+            t_read = time.perf_counter()
+            for offset, line in f:
 
                 # Process one line: lowercase and split into tokens.
                 if self.lowercase:
                     line = line.lower()
                 tokens = line.split()
                 self.word_count += len(tokens)
+                line_pairs = 0
 
-                # Remove some words, then encode as integers.
-                encoded = [ self.voc.get(t, 0) for t in self.prune(tokens) ]
+                # Encode as integers, then remove some words.
+                encoded = self.encode(tokens)
+                self.metrics.add('read', time.perf_counter() - t_read)
+                encoded, _ = self.prune(encoded)
+                t_pairs = time.perf_counter()
+                encoded = encoded.tolist()
 
                 for i, t in enumerate(encoded):
 
                     # The context width is selected uniformly between 1 and the maximal width.
+                    # Tokens without any context don't produce pairs, so we may run out of widths
+                    # before the batch is full.
+                    if width_ix == len(widths):
+                        widths = np.random.randint(1, self.ctx_width+1, size=self.batch_size)
+                        width_ix = 0
                     w = widths[width_ix]
                     width_ix += 1
 
@@ -159,25 +537,388 @@ class SGNSContextGenerator:
                     # Finally, generate target--context pairs.
                     for j in range(start, end):
                         if j != i:
+                            line_pairs += 1
+                            if line_pairs <= skip:
+                                continue
                             out_t.append(encoded[i])
                             out_c.append(encoded[j])
                             
                             # If we've generate enough pairs, yield a batch.
                             # Each batch is a list of targets and a list of corresponding contexts.
                             if len(out_t) == self.batch_size:
+                                self.positions.append((offset, self.word_count - len(tokens), line_pairs))
+                                t_yield = time.perf_counter()
                                 yield out_t, out_c
+                                # The time we were suspended doesn't count as pair generation.
+                                t_pairs += time.perf_counter() - t_yield
                                 
                                 # After coming back, reset the batch.
                                 widths = np.random.randint(1, self.ctx_width+1, size=self.batch_size)
                                 width_ix = 0
                                 out_t = []
                                 out_c = []
+                skip = 0
+                t_read = time.perf_counter()
+                self.metrics.add('pairs', t_read - t_pairs)
                     
             print('End of file.')
             if len(out_t) > 0:
                 # Yield the final batch.
+                self.positions.append((offset, self.word_count - len(tokens), line_pairs))
                 yield out_t, out_c
 
+    def set_shard(self, index, n_shards):
+        # Restricts the generator to one of n_shards roughly equal parts of the corpus.
+        self.shard = (index, n_shards)
+
+    def continue_from(self, state):
+        # Makes the next call to batches continue from a position recorded in self.positions.
+        self.start_state = state
+
+    def open_corpus(self, position=None, whole=False):
+        # Opens the corpus, or our shard of it (unless whole is set), for reading lines and their byte offsets.
+        # If a position is given, we start reading at that byte offset.
+        start, end = 0, os.path.getsize(self.corpus)
+        if self.shard is not None and not whole:
+            index, n_shards = self.shard
+            shards = line_aligned_shards(self.corpus, n_shards)
+            start, end = shards[index] if index < len(shards) else (0, 0)
+        if position is not None:
+            start = max(start, position)
+        return contextlib.closing(read_lines_with_offsets(self.corpus, start, end))
+
+    def read_chunks(self, position=None, whole=False):
+        # Reads the corpus in chunks of lines, lowercasing if needed.
+        # Yields the byte offset of the first line and the lines of each chunk.
+        with self.open_corpus(position, whole) as f:
+            while True:
+                t0 = time.perf_counter()
+                chunk = list(islice(f, self.chunk_lines))
+                if not chunk:
+                    break
+                offsets, chunk = zip(*chunk)
+                if self.lowercase:
+                    chunk = list(map(str.lower, chunk))
+                self.metrics.add('read', time.perf_counter() - t0)
+                yield offsets[0], chunk
+
+    def encode_chunk(self, lines):
+        # Splits, prunes and encodes a chunk of lines.
+        # Returns an int32 array of word ids and an array of the same length
+        # storing the line number (within the chunk) of each token.
+        with self.metrics.timer('read'):
+            split_lines = list(map(str.split, lines))
+            lengths = list(map(len, split_lines))
+            tokens = list(chain.from_iterable(split_lines))
+            self.word_count += len(tokens)
+
+            line_ix = np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+            ids = self.encode(tokens)
+        ids, keep = self.prune(ids)
+        return ids, line_ix[keep]
+
+    def make_pairs(self, ids, line_ix):
+        # Generates all target--context pairs for a sequence of encoded tokens.
+        # Tokens only see contexts in the same line, as in the loop-based version.
+        t0 = time.perf_counter()
+        n = len(ids)
+        W = self.ctx_width
+
+        # The context width for each target is selected uniformly between 1 and the maximal width.
+        widths = np.random.randint(1, W+1, size=n)
+
+        # The offsets to the context positions, in the same order as the loop-based version
+        # generates them: from left to right, skipping the target itself.
+        offsets = np.concatenate([np.arange(-W, 0), np.arange(1, W+1)])
+
+        # shape: (number of tokens, 2 * max width)
+        positions = np.arange(n)[:, None] + offsets[None, :]
+        valid = (np.abs(offsets)[None, :] <= widths[:, None]) & (positions >= 0) & (positions < n)
+        positions = np.clip(positions, 0, max(n-1, 0))
+        valid &= line_ix[positions] == line_ix[:, None]
+
+        # Flattening the mask row by row keeps the pairs grouped by target.
+        tgt = np.broadcast_to(ids[:, None], positions.shape)[valid]
+        ctx = ids[positions[valid]]
+        tgt, ctx = tgt.astype(np.int64), ctx.astype(np.int64)
+        self.metrics.add('pairs', time.perf_counter() - t0)
+        return tgt, ctx
+
+    def rebatch(self, pair_chunks):
+        # Collects pairs from a sequence of (position, word count, targets, contexts) tuples and
+        # yields them in batches of exactly the batch size (except the last one).
+        buf_t = []
+        buf_c = []
+        n_buf = 0
+
+        # For the chunks that still have pairs in the buffer, we keep track of
+        # [position, word count, pairs used, pairs left], so that we know where to continue after each batch.
+        chunks = deque()
+        skip = self.skip_pairs
+        for position, word_count, t, c in pair_chunks:
+            # If we continue from a checkpoint, we skip the pairs of the first chunk that were already used.
+            buf_t.append(t[skip:])
+            buf_c.append(c[skip:])
+            n_buf += len(buf_t[-1])
+            chunks.append([position, word_count, skip, len(buf_t[-1])])
+            skip = 0
+            if n_buf >= self.batch_size:
+                t = np.concatenate(buf_t)
+                c = np.concatenate(buf_c)
+                start = 0
+                while n_buf - start >= self.batch_size:
+                    self.use_pairs(chunks, self.batch_size)
+                    yield t[start:start+self.batch_size], c[start:start+self.batch_size]
+                    start += self.batch_size
+                buf_t = [t[start:]]
+                buf_c = [c[start:]]
+                n_buf -= start
+        print('End of file.')
+        if n_buf > 0:
+            # Yield the final batch.
+            self.use_pairs(chunks, n_buf)
+            yield np.concatenate(buf_t), np.concatenate(buf_c)
+
+    def use_pairs(self, chunks, n):
+        # Marks n pairs in the buffered chunks as used, and records where to continue afterwards.
+        while True:
+            chunk = chunks[0]
+            used = min(n, chunk[3])
+            chunk[2] += used
+            chunk[3] -= used
+            n -= used
+            if chunk[3] > 0 or len(chunks) == 1:
+                break
+            chunks.popleft()
+        self.positions.append(tuple(chunk[:3]))
+
+    def batches_vectorized(self):
+        # The same as batches, but processing a whole chunk of lines at a time with array operations.
+        # Note that the word count is read before encode_chunk adds the words of the chunk.
+        yield from self.rebatch((offset, self.word_count, *self.make_pairs(*self.encode_chunk(lines)))
+                                for offset, lines in self.read_chunks(self.start_position))
+
+    def cache_paths(self):
+        base = os.path.join(self.cache_dir, f'corpus-{self.cache_key}')
+        return base + '.ids', base + '.lines'
+
+    def encode_corpus(self):
+        # Encodes the whole corpus once and stores it on disk as a flat array of uint32 word ids,
+        # together with an int64 array of line start offsets (with the total number of tokens at the end).
+        # Out-of-vocabulary words are stored as the vocabulary size, so that we can treat them
+        # differently from the dummy token when pruning.
+        # The cache always covers the whole corpus, even if this generator only reads a shard of it.
+        ids_file, lines_file = self.cache_paths()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        print('Encoding the corpus...')
+        oov = len(self.voc)
+        n_tokens = 0
+        offsets = [np.zeros(1, dtype=np.int64)]
+        # The temporary files are specific to this process, in case several processes encode at the same time.
+        tmp = f'.{os.getpid()}.tmp'
+        with open(ids_file + tmp, 'wb') as f_ids:
+            for _, lines in self.read_chunks(whole=True):
+                split_lines = list(map(str.split, lines))
+                lengths = np.fromiter(map(len, split_lines), dtype=np.int64, count=len(split_lines))
+                tokens = chain.from_iterable(split_lines)
+                ids = np.fromiter(map(self.voc.get, tokens, repeat(oov)), dtype=np.uint32, count=int(lengths.sum()))
+                ids.tofile(f_ids)
+                offsets.append(n_tokens + np.cumsum(lengths))
+                n_tokens += len(ids)
+        np.concatenate(offsets).tofile(lines_file + tmp)
+        # Move the files into place only when they are complete.
+        os.replace(lines_file + tmp, lines_file)
+        os.replace(ids_file + tmp, ids_file)
+        print(f'Encoded {n_tokens} tokens.')
+
+    def open_cache(self):
+        # Memory-maps the encoded corpus, encoding it first if necessary.
+        ids_file, lines_file = self.cache_paths()
+        if not (os.path.exists(ids_file) and os.path.exists(lines_file)):
+            self.encode_corpus()
+        offsets = np.fromfile(lines_file, dtype=np.int64)
+        if offsets[-1] == 0:
+            # np.memmap can't map empty files.
+            return np.zeros(0, dtype=np.uint32), offsets
+        return np.memmap(ids_file, dtype=np.uint32, mode='r'), offsets
+
+    def encoded_chunks(self, ids, offsets):
+        # Reads the memory-mapped corpus in chunks of lines and prunes it.
+        # Returns the first line number and the word count before each chunk, and then
+        # the same thing as encode_chunk, but without any string processing.
+        first_line, n_lines = 0, len(offsets) - 1
+        if self.shard is not None:
+            index, n_shards = self.shard
+            first_line, n_lines = n_lines * index // n_shards, n_lines * (index+1) // n_shards
+        if self.start_position is not None:
+            first_line = max(first_line, self.start_position)
+        for start in range(first_line, n_lines, self.chunk_lines):
+            t0 = time.perf_counter()
+            end = min(start + self.chunk_lines, n_lines)
+            chunk = np.asarray(ids[offsets[start]:offsets[end]], dtype=np.int32)
+            line_ix = np.repeat(np.arange(end - start, dtype=np.int32), np.diff(offsets[start:end+1]))
+            word_count = self.word_count
+            self.word_count += len(chunk)
+            self.metrics.add('read', time.perf_counter() - t0)
+
+            chunk, keep = self.prune(chunk)
+            yield start, word_count, chunk, line_ix[keep]
+
+    def batches_cached(self):
+        # The same as batches_vectorized, but reading the pre-encoded corpus.
+        ids, offsets = self.open_cache()
+        yield from self.rebatch((start, word_count, *self.make_pairs(chunk, line_ix))
+                                for start, word_count, chunk, line_ix in self.encoded_chunks(ids, offsets))
+
+def corpus_cache_key(corpus, ns_table, lowercase):
+    # Identifies an encoded corpus by the corpus file (name, size and modification time),
+    # the preprocessing, and the vocabulary. We don't hash the whole corpus, since that
+    # would require reading it each time.
+    h = hashlib.sha1()
+    st = os.stat(corpus)
+    h.update(f'{os.path.abspath(corpus)} {st.st_size} {st.st_mtime_ns} {lowercase}\n'.encode('utf-8'))
+    for w in ns_table_arrays(ns_table)[0]:
+        h.update(w.encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()[:16]
+
+# Generating the pairs in several processes.
+# A single process can't generate pairs fast enough for large batches, so we can start a pool of
+# worker processes, each of which generates batches from its own shard of the corpus.
+# The workers write the batches into a set of shared memory slots, and tell the main process
+# which slot to read via a queue. After the main process has copied the batch, it gives the slot
+# back to the worker. In the ordered mode, we take the batches from the workers in a fixed round-robin
+# order, so that the result is reproducible; in the unordered mode, we use whichever batch is ready first.
+
+class ParallelContextGenerator:
+
+    def __init__(self, instance_gen, params):
+        self.instance_gen = instance_gen
+        self.voc = instance_gen.voc
+        self.batch_size = instance_gen.batch_size
+        self.n_workers = params['generator-workers']
+        self.ordered = params.get('generator-order', 'ordered') == 'ordered'
+        self.n_slots = params.get('generator-slots', 4)
+        self.seed = params.get('seed', 0)
+        self.word_count = 0
+        self.epoch = 0
+
+    def batches(self):
+        # If we use the encoded corpus, we create it before starting the workers, so that they don't all encode it.
+        if self.instance_gen.cache_dir:
+            self.instance_gen.open_cache()
+
+        mp = multiprocessing.get_context('fork')
+        n_slots = self.n_workers * self.n_slots
+        # Each slot stores the targets and contexts of one batch.
+        shm = shared_memory.SharedMemory(create=True, size=n_slots * 2 * self.batch_size * 8)
+        slots = np.ndarray((n_slots, 2, self.batch_size), dtype=np.int64, buffer=shm.buf)
+        results = mp.Queue()
+        free_slots = [mp.Queue() for _ in range(self.n_workers)]
+        for i in range(self.n_workers):
+            for j in range(self.n_slots):
+                free_slots[i].put(i * self.n_slots + j)
+
+        seed = (self.seed * 1000 + self.epoch) * self.n_workers
+        workers = [mp.Process(target=context_generator_worker,
+                              args=(i, self.n_workers, seed + i, self.instance_gen, shm.name, n_slots, free_slots[i], results),
+                              daemon=True)
+                   for i in range(self.n_workers)]
+        for p in workers:
+            p.start()
+
+        word_counts = [0] * self.n_workers
+        self.word_count = 0
+        pending = [deque() for _ in range(self.n_workers)]
+        active = list(range(self.n_workers))
+        turn = 0
+        try:
+            while active:
+                if self.ordered:
+                    # We wait for the batch from the worker whose turn it is.
+                    turn %= len(active)
+                    worker_id = active[turn]
+                    while not pending[worker_id]:
+                        self.receive(results, pending, workers)
+                    msg = pending[worker_id].popleft()
+                else:
+                    # We take any batch that's ready.
+                    while not any(pending[i] for i in active):
+                        self.receive(results, pending, workers)
+                    worker_id = next(i for i in active if pending[i])
+                    msg = pending[worker_id].popleft()
+
+                kind, slot, n, word_count = msg
+                word_counts[worker_id] = word_count
+                self.word_count = sum(word_counts)
+                if kind == 'end':
+                    active.remove(worker_id)
+                    continue
+                turn += 1
+
+                # Copy the batch, and give the slot back to the worker.
+                t = slots[slot, 0, :n].copy()
+                c = slots[slot, 1, :n].copy()
+                free_slots[worker_id].put(slot)
+                yield t, c
+        finally:
+            for p in workers:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+            del slots
+            shm.close()
+            shm.unlink()
+            self.epoch += 1
+
+    def receive(self, results, pending, workers):
+        # Waits for a message from a worker, and checks that no worker has crashed.
+        while True:
+            try:
+                msg = results.get(timeout=1)
+                break
+            except queue_module.Empty:
+                for i, p in enumerate(workers):
+                    if not p.is_alive() and p.exitcode != 0:
+                        raise RuntimeError(f'Context generation worker {i} died with exit code {p.exitcode}')
+        worker_id, kind = msg[0], msg[1]
+        if kind == 'error':
+            raise RuntimeError(f'Context generation worker {worker_id} failed:\n{msg[2]}')
+        pending[worker_id].append(msg[1:])
+
+def context_generator_worker(worker_id, n_workers, seed, instance_gen, shm_name, n_slots, free_slots, results):
+    # Generates the batches from one shard of the corpus. This runs in a worker process.
+    try:
+        np.random.seed(seed)
+        shm = shared_memory.SharedMemory(name=shm_name)
+        slots = np.ndarray((n_slots, 2, instance_gen.batch_size), dtype=np.int64, buffer=shm.buf)
+        instance_gen.set_shard(worker_id, n_workers)
+        for t, c in instance_gen.batches():
+            slot = free_slots.get()
+            n = len(t)
+            slots[slot, 0, :n] = t
+            slots[slot, 1, :n] = c
+            results.put((worker_id, 'batch', slot, n, instance_gen.word_count))
+        results.put((worker_id, 'end', None, 0, instance_gen.word_count))
+        del slots
+        shm.close()
+    except Exception:
+        results.put((worker_id, 'error', traceback.format_exc()))
+
+def benchmark_context_generator(ns_table, params, max_batches=10):
+    # Compares the pairs per second of the loop-based and vectorized pair generation.
+    for vectorized in [False, True]:
+        gen = SGNSContextGenerator(ns_table, dict(params, **{'vectorized-pairs': vectorized}))
+        n_pairs = 0
+        t0 = time.time()
+        for i, (t, _) in enumerate(gen.batches(), 1):
+            n_pairs += len(t)
+            if i == max_batches:
+                break
+        t1 = time.time()
+        name = 'vectorized' if vectorized else 'loops'
+        print(f'Pair generation ({name}): {n_pairs} pairs, {n_pairs/(t1-t0):.0f} pairs/sec')
+
 # Next, we implement the neural network that defines the model. 
 # The parameters just consist of two sets of embeddings: one for the target words, and one for the contexts.
 
@@ -194,16 +935,32 @@ class SGNSModel(nn.Module):
         super().__init__()
         
         voc_size = len(voc)
+
+        # With sparse gradients, the backward step only produces gradients for the rows
+        # used in the batch, instead of a full (voc size, emb dim) tensor.
+        sparse = params.get('sparse', False)
         
         # Target word embeddings
-        self.w = nn.Embedding(voc_size, params['emb-dim'])
+        self.w = nn.Embedding(voc_size, params['emb-dim'], sparse=sparse)
         # Context embeddings
-        self.c = nn.Embedding(voc_size, params['emb-dim'])
+        self.c = nn.Embedding(voc_size, params['emb-dim'], sparse=sparse)
         
         # Some things we need to print nearest neighbor lists for diagnostics.
         self.voc = voc
         self.ivoc = { i:w for w, i in voc.items() }
 
+        # The normalized embeddings used when searching for nearest neighbors and computing
+        # similarities, with the version of the embeddings they were computed from.
+        self.version = 0
+        self.normalized = {}
+
+        # An alternative representation used for similarity queries (see use_backend).
+        self.backend = None
+
+        # The block sizes (number of vocabulary rows and number of queries) for the search.
+        self.nn_block_size = params.get('nn-block-size', 1<<16)
+        self.nn_query_block = params.get('nn-query-block', 1024)
+
     def forward(self, tgt, ctx):       
         # tgt is a 1-dimensional tensor containing target word ids
         # ctx is a 2-dimensional tensor containing positive and negative context ids for each target
@@ -239,30 +996,135 @@ class SGNSModel(nn.Module):
         return dots
     
     
+    def bump_version(self):
+        # Should be called whenever the embeddings have been changed, e.g. after an optimizer step.
+        self.version += 1
+
+    def normalized_embeddings(self, table='w'):
+        # The target (w) or context (c) embeddings as float32 vectors scaled to unit length,
+        # so that dot products are cosine similarities. They are computed when first needed,
+        # and kept until the version counter changes.
+        cached = self.normalized.get(table)
+        if cached is None or cached[0] != self.version:
+            weight = getattr(self, table).weight
+            with torch.no_grad():
+                cached = (self.version, nn.functional.normalize(weight.detach().float(), dim=1))
+            self.normalized[table] = cached
+        return cached[1]
+
+    def search(self, queries, k):
+        # Finds the k highest-scoring words for each (normalized) query vector.
+        # Returns the scores and word indices, each of shape (nbr of queries, k).
+        return self.blocked_topk(len(queries), k, lambda q_start, q_end, block, start: queries[q_start:q_end].mm(block.t()))
+
+    def blocked_topk(self, n_queries, k, score_block, query_block=None):
+        # Finds the k highest-scoring words for each query, where score_block(q_start, q_end, block, start)
+        # computes the scores of the queries q_start to q_end for a block of normalized embeddings
+        # starting at word index start. To keep the memory bounded, we compute the scores over blocks
+        # of queries (query_block at a time, by default nn_query_block) and blocks of the vocabulary,
+        # and keep a running top-k list.
+        query_block = query_block or self.nn_query_block
+        all_emb = self.normalized_embeddings()
+        voc_size = all_emb.shape[0]
+        k = min(k, voc_size)
+        if n_queries == 0:
+            return torch.empty((0, k), device=all_emb.device), torch.empty((0, k), dtype=torch.long, device=all_emb.device)
+        out_values = []
+        out_indices = []
+        with torch.no_grad():
+            for q_start in range(0, n_queries, query_block):
+                q_end = min(q_start + query_block, n_queries)
+                values = torch.empty((q_end - q_start, 0), device=all_emb.device)
+                indices = torch.empty((q_end - q_start, 0), dtype=torch.long, device=all_emb.device)
+                for start in range(0, voc_size, self.nn_block_size):
+                    block = all_emb[start:start+self.nn_block_size]
+                    # shape: (nbr of queries, block size)
+                    scores = score_block(q_start, q_end, block, start)
+                    block_top = scores.topk(min(k, len(block)), dim=1)
+                    # Merge this block's best words with the best words so far.
+                    values = torch.cat([values, block_top.values], dim=1)
+                    indices = torch.cat([indices, block_top.indices + start], dim=1)
+                    top = values.topk(min(k, values.shape[1]), dim=1)
+                    values = top.values
+                    indices = indices.gather(1, top.indices)
+                out_values.append(values)
+                out_indices.append(indices)
+        return torch.cat(out_values), torch.cat(out_indices)
+
+    def analogies(self, triples, k=1, method='add'):
+        # Solves a batch of analogy questions "a is to b as c is to ?".
+        # With the 3CosAdd method, the answer is the word most similar to b - a + c.
+        # With 3CosMul (Levy and Goldberg, 2014), we instead maximize cos(d, b) cos(d, c) / (cos(d, a) + eps),
+        # with the cosines shifted to the range [0, 1].
+        # The input words are never returned as answers.
+        # Returns a list with k (word, score) pairs for each triple, or None if some word is unknown.
+        all_emb = self.normalized_embeddings()
+        known = [ all(w in self.voc for w in t) for t in triples ]
+        ix = torch.as_tensor([[self.voc[w] for w in t] for t, ok in zip(triples, known) if ok], dtype=torch.long)
+        ix = ix.view(-1, 3).to(all_emb.device)
+        a, b, c = all_emb[ix[:, 0]], all_emb[ix[:, 1]], all_emb[ix[:, 2]]
+        if method == 'add':
+            queries = nn.functional.normalize(b - a + c, dim=1)
+        elif method != 'mul':
+            raise ValueError(f'Unknown analogy method: {method}')
+        if len(ix) == 0:
+            return [None] * len(triples)
+
+        def score_block(q_start, q_end, block, start):
+            if method == 'add':
+                scores = queries[q_start:q_end].mm(block.t())
+            else:
+                # We compute the three similarities with a single matrix multiplication.
+                n = q_end - q_start
+                sims = torch.cat([a[q_start:q_end], b[q_start:q_end], c[q_start:q_end]]).mm(block.t())
+                sims.add_(1).mul_(0.5)
+                sim_a, sim_b, sim_c = sims[:n], sims[n:2*n], sims[2*n:]
+                scores = sim_b.mul_(sim_c).div_(sim_a.add_(1e-3))
+            # Exclude the input words that are in this block.
+            local = ix[q_start:q_end] - start
+            rows = torch.arange(q_end - q_start, device=local.device).view(-1, 1).expand_as(local)
+            in_block = (local >= 0) & (local < len(block))
+            scores[rows[in_block], local[in_block]] = -float('inf')
+            return scores
+
+        # 3CosMul computes three score matrices for each query block, so we use a third of the block size
+        # to keep the peak memory the same as for 3CosAdd.
+        query_block = self.nn_query_block if method == 'add' else max(1, self.nn_query_block // 3)
+        values, indices = self.blocked_topk(len(ix), k, score_block, query_block)
+
+        # Map the results back to strings, with None for the triples we couldn't answer.
+        answers = iter(zip(indices.tolist(), values.tolist()))
+        out = []
+        for ok in known:
+            if ok:
+                ixs, vals = next(answers)
+                out.append([ (self.ivoc[i], v) for i, v in zip(ixs, vals) ])
+            else:
+                out.append(None)
+        return out
+
+    def use_backend(self, backend):
+        # Answers the similarity queries using another representation of the embeddings,
+        # such as Int8Embeddings. If backend is None, we use the model's own embeddings.
+        self.backend = backend
+
     def nearest_neighbors(self, words, n_neighbors):
+        if self.backend is not None:
+            return self.backend.nearest_neighbors(words, n_neighbors)
         
         # Encode the words as integers, and put them into a PyTorch tensor.
         words_ix = torch.as_tensor([self.voc[w] for w in words])
         
-        # Look up the embeddings for the test words.
-        voc_size, emb_dim = self.w.weight.shape
-        test_emb = self.w(words_ix).view(len(words), 1, emb_dim)
-
-        # Also, get the embeddings for all words in the vocabulary.
-        all_emb = self.w.weight.view(1, voc_size, emb_dim)
-
-        # We'll use a cosine similarity function to find the most similar words.
-        # The .view kludgery above is needed for the batch-wise cosine similarity.
-        sim_func = nn.CosineSimilarity(dim=2)
-        scores = sim_func(test_emb, all_emb)
-        # The shape of scores is (nbr of test words, total number of words)
+        # Look up the normalized embeddings for the test words.
+        all_emb = self.normalized_embeddings()
+        test_emb = all_emb[words_ix.to(all_emb.device)]
                 
-        # Find the top-scoring columns in each row.
+        # Find the top-scoring words for each test word. The top word is normally the test word itself, so we skip it.
         if not n_neighbors:
             n_neighbors = self.n_testwords_neighbors
-        near_nbr = scores.topk(n_neighbors+1, dim=1)
-        values = near_nbr.values[:,1:]
-        indices = near_nbr.indices[:, 1:]
+        values, indices = self.search(test_emb, n_neighbors+1)
+        values = values[:,1:]
+        indices = indices[:, 1:]
         
         # Finally, map word indices back to strings, and put the result in a list.
         out = []
@@ -272,11 +1134,1445 @@ class SGNSModel(nn.Module):
         
         
     def cosine_similarity(self, word1, word2):        
-        # We just look up the two embeddings and use PyTorch's built-in cosine similarity.
-        v1 = self.w(torch.as_tensor(self.voc[word1]))
-        v2 = self.w(torch.as_tensor(self.voc[word2]))
-        sim = nn.CosineSimilarity(dim=0)
-        return sim(v1, v2).item()
+        if self.backend is not None:
+            return self.backend.cosine_similarity(word1, word2)
+        # We just look up the two normalized embeddings and compute their dot product.
+        all_emb = self.normalized_embeddings()
+        return all_emb[self.voc[word1]].dot(all_emb[self.voc[word2]]).item()
+
+    def lookup(self, words):
+        # Returns the indices of the words, and a list of the positions of unknown words.
+        # Unknown words get the index 0.
+        ix = np.fromiter(map(self.voc.get, words, repeat(-1)), dtype=np.int64, count=len(words))
+        oov = np.flatnonzero(ix < 0).tolist()
+        ix[oov] = 0
+        return torch.from_numpy(ix), oov
+
+    def cosine_similarities(self, pairs):
+        # Computes the cosine similarities for a list of word pairs at once.
+        # Returns a NumPy array with the similarities (NaN for pairs containing unknown words),
+        # and a list of the positions of those pairs.
+        if self.backend is not None:
+            oov = [ i for i, (w1, w2) in enumerate(pairs) if w1 not in self.voc or w2 not in self.voc ]
+            sims = np.array([ self.backend.cosine_similarity(w1, w2) if w1 in self.voc and w2 in self.voc else np.nan
+                              for w1, w2 in pairs ], dtype=np.float32)
+            return sims, oov
+        ix1, oov1 = self.lookup([ w1 for w1, _ in pairs ])
+        ix2, oov2 = self.lookup([ w2 for _, w2 in pairs ])
+        with torch.inference_mode():
+            all_emb = self.normalized_embeddings()
+            ix1 = ix1.to(all_emb.device)
+            ix2 = ix2.to(all_emb.device)
+            sims = (all_emb.index_select(0, ix1) * all_emb.index_select(0, ix2)).sum(dim=1).cpu().numpy()
+        oov = sorted(set(oov1) | set(oov2))
+        sims[oov] = np.nan
+        return sims, oov
+
+    def similarity_matrix(self, words1, words2):
+        # Computes the cosine similarities between all words in words1 and all words in words2.
+        # Returns a NumPy array of shape (len(words1), len(words2)), with NaN for unknown words,
+        # and the lists of positions of unknown words in words1 and words2.
+        ix1, oov1 = self.lookup(words1)
+        ix2, oov2 = self.lookup(words2)
+        if self.backend is not None:
+            # The backends only compare one pair at a time.
+            sims, _ = self.cosine_similarities([ (w1, w2) for w1 in words1 for w2 in words2 ])
+            return sims.reshape(len(words1), len(words2)), oov1, oov2
+        with torch.inference_mode():
+            all_emb = self.normalized_embeddings()
+            emb1 = all_emb.index_select(0, ix1.to(all_emb.device))
+            emb2 = all_emb.index_select(0, ix2.to(all_emb.device))
+            sims = emb1.mm(emb2.t()).cpu().numpy()
+        sims[oov1, :] = np.nan
+        sims[:, oov2] = np.nan
+        return sims, oov1, oov2
+
+# Evaluating with analogies.
+# The analogy file is in the format used by word2vec: each line contains four words a b c d, meaning
+# that a is to b as c is to d, and lines starting with a colon start a new section.
+
+def load_analogies(filename, lowercase=True):
+    questions = []
+    with open(filename) as f:
+        for line in f:
+            if line.startswith(':'):
+                continue
+            if lowercase:
+                line = line.lower()
+            t = line.split()
+            if len(t) == 4:
+                questions.append(t)
+    return questions
+
+def evaluate_analogies(model, filename, method='add', lowercase=True):
+    # Prints the accuracy of the model on the analogy questions, and the time it took.
+    questions = load_analogies(filename, lowercase)
+    t0 = time.time()
+    answers = model.analogies([q[:3] for q in questions], 1, method)
+    t1 = time.time()
+    n_answered = sum(1 for a in answers if a is not None)
+    n_correct = sum(1 for q, a in zip(questions, answers) if a is not None and a[0][0] == q[3])
+    print(f'Analogies (3Cos{method.capitalize()}): {n_correct}/{n_answered} correct ({n_correct/max(n_answered, 1):.3f}), '
+          f'{len(questions) - n_answered} skipped, time: {t1-t0:.2f}')
+    return n_correct / max(n_answered, 1)
+
+# Precomputing the nearest neighbors of every word.
+# We split the vocabulary into blocks of rows, and find the top k neighbors for each block in a pool
+# of worker processes. The results are written directly into two memory-mapped files: filename.ids
+# (int32, shape (voc size, k)) and filename.scores (float16, same shape). A third file, filename.done,
+# has one byte per block that is set when the block is finished, so an interrupted job can be resumed.
+# The settings of the job are stored in filename.json, so that we only resume a job that computed the same thing.
+
+neighbor_job_model = None
+
+def neighbor_block_worker(args):
+    # Computes the neighbors for one block of rows. This runs in a worker process (or in the main process).
+    filename, block, block_size, k = args
+    model = neighbor_job_model
+    all_emb = model.normalized_embeddings()
+    voc_size = len(all_emb)
+    start, end = block * block_size, min((block+1) * block_size, voc_size)
+    rows = torch.arange(start, end, device=all_emb.device)
+
+    values, indices = model.search(all_emb[rows], k+1)
+    # Remove each word from its own list: we sort it last (if it's there), then keep the first k.
+    is_self = (indices == rows.view(-1, 1)).to(torch.uint8)
+    order = is_self.argsort(dim=1, stable=True)[:, :k]
+    values = values.gather(1, order).cpu().numpy()
+    indices = indices.gather(1, order).cpu().numpy()
+
+    ids_out = np.memmap(filename + '.ids', dtype=np.int32, mode='r+', shape=(voc_size, k))
+    scores_out = np.memmap(filename + '.scores', dtype=np.float16, mode='r+', shape=(voc_size, k))
+    ids_out[start:end] = indices
+    scores_out[start:end] = values
+    ids_out.flush()
+    scores_out.flush()
+    return block
+
+def neighbor_job_settings(model, k, block_size):
+    # Describes a neighbor job. The checksums identify the vocabulary and the embeddings.
+    voc_crc = 0
+    for i in range(len(model.voc)):
+        voc_crc = zlib.crc32(model.ivoc[i].encode('utf-8') + b'\n', voc_crc)
+    weight = model.w.weight.detach().float().cpu().numpy()
+    return { 'voc-size': len(model.voc), 'k': k, 'block-size': block_size,
+             'voc-crc': voc_crc, 'weights-crc': zlib.crc32(weight) }
+
+def load_neighbor_job_settings(filename):
+    with open(filename + '.json') as f:
+        return json.load(f)
+
+def precompute_neighbors(model, filename, k=50, block_size=4096, workers=1):
+    global neighbor_job_model
+    voc_size = len(model.voc)
+    k = min(k, voc_size - 1)
+    n_blocks = (voc_size + block_size - 1) // block_size
+    settings = neighbor_job_settings(model, k, block_size)
+
+    # We can only resume an earlier job if it had the same settings and the same model.
+    resume = os.path.exists(filename + '.done') and os.path.exists(filename + '.json')
+    if resume and load_neighbor_job_settings(filename) != settings:
+        print(f'{filename} was computed with different settings or a different model, so we start over.')
+        resume = False
+
+    # Create the output files, unless we are resuming an earlier job.
+    # The .done file is written last, so it only exists if the others are complete.
+    if not resume:
+        if os.path.exists(filename + '.done'):
+            os.remove(filename + '.done')
+        with open(filename + '.json', 'w') as f:
+            json.dump(settings, f)
+        np.memmap(filename + '.ids', dtype=np.int32, mode='w+', shape=(voc_size, k)).flush()
+        np.memmap(filename + '.scores', dtype=np.float16, mode='w+', shape=(voc_size, k)).flush()
+        np.zeros(n_blocks, dtype=np.uint8).tofile(filename + '.done')
+    done = np.memmap(filename + '.done', dtype=np.uint8, mode='r+')
+    todo = [ b for b in range(n_blocks) if not done[b] ]
+    print(f'Computing neighbors: {len(todo)} of {n_blocks} blocks left.')
+
+    # The workers are forked, so they get the model (with its normalized embeddings) from this global variable.
+    neighbor_job_model = model
+    # CUDA can't be used in forked processes, but on a GPU a single process is fast anyway,
+    # so we only use the pool on the CPU.
+    if model.normalized_embeddings().is_cuda and workers > 1:
+        print('The embeddings are on a GPU, so we compute the neighbors in this process.')
+        workers = 1
+    jobs = [ (filename, b, block_size, k) for b in todo ]
+    t0 = time.time()
+    n_rows = 0
+    # Each worker uses a single thread, so that the workers don't compete for the cores.
+    pool = multiprocessing.get_context('fork').Pool(workers, torch.set_num_threads, (1,)) if workers > 1 else None
+    try:
+        results = pool.imap_unordered(neighbor_block_worker, jobs) if pool else map(neighbor_block_worker, jobs)
+        for i, block in enumerate(results, 1):
+            done[block] = 1
+            done.flush()
+            n_rows += min(block_size, voc_size - block * block_size)
+            if i % 10 == 0 or i == len(jobs):
+                print(f'{i}/{len(jobs)} blocks, {n_rows/(time.time()-t0):.0f} rows/sec')
+    finally:
+        if pool:
+            pool.terminate()
+        neighbor_job_model = None
+
+def load_neighbors(filename):
+    # Memory-maps the results of precompute_neighbors: arrays of neighbor ids and scores, each of shape (voc size, k).
+    settings = load_neighbor_job_settings(filename)
+    shape = (settings['voc-size'], settings['k'])
+    ids = np.memmap(filename + '.ids', dtype=np.int32, mode='r', shape=shape)
+    scores = np.memmap(filename + '.scores', dtype=np.float16, mode='r', shape=shape)
+    return ids, scores
+
+# Approximate nearest neighbor search.
+# Exact search compares each query with every word in the vocabulary. An inverted file (IVF) index
+# instead clusters the (normalized) embeddings with k-means, and stores the words in one list per cluster.
+# When searching, we only look at the words in the n_probe lists whose centroids are closest to the query.
+
+def model_embeddings(model):
+    # The normalized target embeddings of a model as a NumPy array, and the words in the same order.
+    emb = model.normalized_embeddings().cpu().numpy()
+    return emb, [model.ivoc[i] for i in range(len(emb))]
+
+def blocked_argmax_dot(vectors, centroids, block_size=1<<16):
+    # For each vector, finds the centroid with the highest dot product.
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        out[start:start+block_size] = (vectors[start:start+block_size] @ centroids.T).argmax(axis=1)
+    return out
+
+def spherical_kmeans(vectors, centroids, n_iter):
+    # Improves a set of unit-length centroids by k-means on the sphere. Empty clusters
+    # get a random vector instead.
+    for _ in range(n_iter):
+        assignment = blocked_argmax_dot(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        sums[empty] = vectors[np.random.randint(len(vectors), size=empty.sum())]
+        norms[empty] = 1
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+def merge_topk(values, ids, new_values, new_ids, k):
+    # Merges two lists of (score, id) for each row, and keeps the k highest scores, sorted.
+    # new_ids contains the ids of the columns of new_values.
+    if new_values.shape[1] > k:
+        top = np.argpartition(-new_values, k-1, axis=1)[:, :k]
+        new_values = np.take_along_axis(new_values, top, axis=1)
+        new_ids = new_ids[top]
+    else:
+        new_ids = np.broadcast_to(new_ids, new_values.shape)
+    values = np.concatenate([values, new_values], axis=1)
+    ids = np.concatenate([ids, new_ids], axis=1)
+    if values.shape[1] > k:
+        top = np.argpartition(-values, k-1, axis=1)[:, :k]
+        values = np.take_along_axis(values, top, axis=1)
+        ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    return np.take_along_axis(values, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+class IVFIndex:
+
+    def __init__(self, n_lists=1024, n_probe=16, n_train=256):
+        # n_lists: the number of clusters
+        # n_probe: the number of clusters we look at for each query
+        # n_train: the number of training vectors per cluster for k-means
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_train = n_train
+        self.centroids = None
+
+    @staticmethod
+    def from_model(model, n_lists=1024, n_probe=16, n_iter=10):
+        index = IVFIndex(n_lists, n_probe)
+        index.build(*model_embeddings(model), n_iter=n_iter)
+        return index
+
+    def build(self, vectors, words, n_iter=10):
+        # Runs k-means on a sample of the vectors, then puts every vector in its cluster's list.
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        n_lists = min(self.n_lists, len(vectors))
+        sample = vectors[np.random.permutation(len(vectors))[:n_lists * self.n_train]]
+        centroids = sample[np.random.permutation(len(sample))[:n_lists]]
+        self.centroids = spherical_kmeans(sample, centroids, n_iter)
+        self.add_all(vectors, words)
+
+    def rebuild(self, vectors, words=None, n_iter=1):
+        # Rebuilds the index for updated embeddings (e.g. from a later training checkpoint),
+        # starting k-means from the current centroids instead of from scratch.
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        sample = vectors[np.random.permutation(len(vectors))[:len(self.centroids) * self.n_train]]
+        self.centroids = spherical_kmeans(sample, self.centroids, n_iter)
+        self.add_all(vectors, self.words if words is None else words)
+
+    def rebuild_from_state_dict(self, state_dict, n_iter=1):
+        # The same as rebuild, but using the target embeddings in a model's state_dict.
+        weight = state_dict['w.weight'].detach().float()
+        self.rebuild(nn.functional.normalize(weight, dim=1).cpu().numpy(), n_iter=n_iter)
+
+    def add_all(self, vectors, words):
+        # Sorts the vectors by cluster, so that each list is a contiguous range.
+        assignment = blocked_argmax_dot(vectors, self.centroids)
+        self.set_order(np.argsort(assignment, kind='stable'))
+        self.vectors = vectors[self.order]
+        counts = np.bincount(assignment, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.words = list(words)
+        self.voc = { w:i for i, w in enumerate(self.words) }
+
+    def set_order(self, order):
+        # order[i] is the word stored in row i of self.vectors; rows[w] is the row of word w.
+        self.order = order
+        self.rows = np.empty_like(order)
+        self.rows[order] = np.arange(len(order))
+
+    def search(self, queries, k):
+        # Finds approximately the k highest-scoring words for each (normalized) query.
+        # Returns arrays of scores and word indices, each of shape (nbr of queries, k).
+        # If fewer than k words were found, the remaining indices are -1.
+        queries = np.asarray(queries, dtype=np.float32)
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe-1, axis=1)[:, :n_probe]
+
+        values = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+
+        # We go through the lists one at a time, and score all the queries that probe the list at once.
+        list_queries = np.argsort(probes, axis=None, kind='stable') // n_probe
+        list_starts = np.searchsorted(np.sort(probes, axis=None), np.arange(len(self.centroids)+1))
+        for l in range(len(self.centroids)):
+            q_ix = list_queries[list_starts[l]:list_starts[l+1]]
+            start, end = self.offsets[l], self.offsets[l+1]
+            if len(q_ix) == 0 or start == end:
+                continue
+            scores = queries[q_ix] @ self.vectors[start:end].T
+            values[q_ix], ids[q_ix] = merge_topk(values[q_ix], ids[q_ix], scores, self.order[start:end], k)
+        return values, ids
+
+    def nearest_neighbors(self, words, n_neighbors):
+        # The same as SGNSModel.nearest_neighbors, but approximate.
+        words_ix = [self.voc[w] for w in words]
+        queries = self.vectors[self.rows[words_ix]]
+        values, ids = self.search(queries, n_neighbors+1)
+        out = []
+        for w_ix, ixs, vals in zip(words_ix, ids, values):
+            nbrs = [ (self.words[ix], float(val)) for ix, val in zip(ixs, vals) if ix != w_ix and ix >= 0 ]
+            out.append(nbrs[:n_neighbors])
+        return out
+
+    def save(self, filename):
+        np.savez(filename, centroids=self.centroids, order=self.order, vectors=self.vectors,
+                 offsets=self.offsets, words=np.array(self.words), n_probe=self.n_probe, n_train=self.n_train)
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        index = IVFIndex(len(data['centroids']), int(data['n_probe']), int(data['n_train']))
+        index.centroids = data['centroids']
+        index.set_order(data['order'])
+        index.vectors = data['vectors']
+        index.offsets = data['offsets']
+        index.words = data['words'].tolist()
+        index.voc = { w:i for i, w in enumerate(index.words) }
+        return index
+
+def benchmark_ann_index(model, index, n_queries=1000, k=10):
+    # Compares an approximate index to exact search: queries per second and recall@k,
+    # that is, the fraction of the exact top k that the index also finds.
+    all_emb = model.normalized_embeddings()
+    query_ix = torch.randint(len(all_emb), (n_queries,))
+    queries = all_emb[query_ix.to(all_emb.device)]
+
+    t0 = time.time()
+    _, exact_ids = model.search(queries, k)
+    t1 = time.time()
+    _, approx_ids = index.search(queries.cpu().numpy(), k)
+    t2 = time.time()
+
+    exact_ids = exact_ids.cpu().numpy()
+    found = sum(len(set(e) & set(a)) for e, a in zip(exact_ids, approx_ids))
+    print(f'Exact: {n_queries/(t1-t0):.0f} queries/sec')
+    print(f'Approximate: {n_queries/(t2-t1):.0f} queries/sec, recall@{k}: {found/exact_ids.size:.3f}')
+
+# Locality-sensitive hashing.
+# Each hash table uses n_bits random hyperplanes: the signature of a vector is the set of sides of
+# the hyperplanes it is on. Vectors with a small angle between them are likely to get the same signature.
+# With several tables, we look up the words with the same signature as the query in each table, and
+# compute the exact cosine similarities for these candidates only.
+# Each table is stored as an array of signatures sorted in increasing order, with the corresponding word ids.
+
+class LSHIndex:
+
+    def __init__(self, emb_dim, n_tables=8, n_bits=16):
+        if n_bits > 62:
+            raise ValueError('At most 62 bits per table are supported')
+        self.planes = np.random.randn(n_tables, n_bits, emb_dim).astype(np.float32)
+        self.powers = 1 << np.arange(n_bits, dtype=np.int64)
+        self.keys = [np.zeros(0, dtype=np.int64) for _ in range(n_tables)]
+        self.ids = [np.zeros(0, dtype=np.int64) for _ in range(n_tables)]
+        self.vectors = np.zeros((0, emb_dim), dtype=np.float32)
+        self.words = []
+        self.voc = {}
+
+    @staticmethod
+    def from_model(model, n_tables=8, n_bits=16):
+        vectors, words = model_embeddings(model)
+        index = LSHIndex(vectors.shape[1], n_tables, n_bits)
+        index.add(vectors, words)
+        return index
+
+    def signatures(self, vectors, table):
+        # shape: (nbr of vectors,)
+        return ((vectors @ self.planes[table].T) > 0) @ self.powers
+
+    def add(self, vectors, words):
+        # Adds (normalized) vectors to the index, e.g. for words that were added to the vocabulary
+        # or rows that were trained further. Words that are already in the index keep their ids,
+        # but their vectors and signatures are replaced. The signatures of the other words are kept.
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n_old = len(self.words)
+        for w in words:
+            if w not in self.voc:
+                self.voc[w] = len(self.words)
+                self.words.append(w)
+        word_ids = np.array([self.voc[w] for w in words], dtype=np.int64)
+
+        # If a word occurs more than once, we use its last vector.
+        _, last = np.unique(word_ids[::-1], return_index=True)
+        rows = np.sort(len(word_ids) - 1 - last)
+        vectors, word_ids = vectors[rows], word_ids[rows]
+
+        replaced = word_ids[word_ids < n_old]
+        for t in range(len(self.planes)):
+            old_keys, old_ids = self.keys[t], self.ids[t]
+            if len(replaced) > 0:
+                keep = ~np.isin(old_ids, replaced)
+                old_keys, old_ids = old_keys[keep], old_ids[keep]
+            keys = np.concatenate([old_keys, self.signatures(vectors, t)])
+            ids = np.concatenate([old_ids, word_ids])
+            # The old part is already sorted, so a stable sort is fast here.
+            order = np.argsort(keys, kind='stable')
+            self.keys[t] = keys[order]
+            self.ids[t] = ids[order]
+        self.vectors = np.concatenate([self.vectors, np.zeros((len(self.words) - n_old, vectors.shape[1]), dtype=np.float32)])
+        self.vectors[word_ids] = vectors
+
+    def candidates(self, queries):
+        # For each query, the ids of the words that have the same signature in some table.
+        starts = []
+        ends = []
+        for t in range(len(self.planes)):
+            keys = self.signatures(queries, t)
+            starts.append(np.searchsorted(self.keys[t], keys, side='left'))
+            ends.append(np.searchsorted(self.keys[t], keys, side='right'))
+        out = []
+        for q in range(len(queries)):
+            found = [self.ids[t][starts[t][q]:ends[t][q]] for t in range(len(self.planes))]
+            out.append(np.unique(np.concatenate(found)))
+        return out
+
+    def search(self, queries, k):
+        # Finds approximately the k most similar words for each (normalized) query.
+        # Returns arrays of scores and word indices, each of shape (nbr of queries, k).
+        # If fewer than k candidates were found, the remaining indices are -1.
+        queries = np.asarray(queries, dtype=np.float32)
+        values = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, cands in enumerate(self.candidates(queries)):
+            scores = self.vectors[cands] @ queries[q]
+            top = np.argsort(-scores, kind='stable')[:k]
+            values[q, :len(top)] = scores[top]
+            ids[q, :len(top)] = cands[top]
+        return values, ids
+
+    def nearest_neighbors(self, words, n_neighbors):
+        # The same as SGNSModel.nearest_neighbors, but approximate.
+        words_ix = [self.voc[w] for w in words]
+        values, ids = self.search(self.vectors[words_ix], n_neighbors+1)
+        out = []
+        for w_ix, ixs, vals in zip(words_ix, ids, values):
+            nbrs = [ (self.words[ix], float(val)) for ix, val in zip(ixs, vals) if ix != w_ix and ix >= 0 ]
+            out.append(nbrs[:n_neighbors])
+        return out
+
+    def cosine_similarity(self, word1, word2):
+        return float(self.vectors[self.voc[word1]].dot(self.vectors[self.voc[word2]]))
+
+    def table_nbytes(self):
+        # The memory used by one hash table.
+        return self.keys[0].nbytes + self.ids[0].nbytes
+
+def benchmark_lsh(model, settings=((4, 12), (8, 12), (8, 16), (16, 16), (16, 20)), n_queries=1000, k=10):
+    # Compares LSH indexes with different numbers of tables and bits to exact search:
+    # build time, memory per table, queries per second and recall@k.
+    all_emb = model.normalized_embeddings()
+    queries = all_emb[torch.randint(len(all_emb), (n_queries,)).to(all_emb.device)]
+    t0 = time.time()
+    _, exact_ids = model.search(queries, k)
+    t1 = time.time()
+    exact_ids = exact_ids.cpu().numpy()
+    queries = queries.cpu().numpy()
+    print(f'Exact: {n_queries/(t1-t0):.0f} queries/sec')
+    for n_tables, n_bits in settings:
+        t0 = time.time()
+        index = LSHIndex.from_model(model, n_tables, n_bits)
+        t1 = time.time()
+        _, approx_ids = index.search(queries, k)
+        t2 = time.time()
+        found = sum(len(set(e) & set(a)) for e, a in zip(exact_ids, approx_ids))
+        print(f'LSH, {n_tables} tables, {n_bits} bits: build {t1-t0:.2f} s, {index.table_nbytes()/(1<<20):.1f} MB/table, '
+              f'{n_queries/(t2-t1):.0f} queries/sec, recall@{k}: {found/exact_ids.size:.3f}')
+
+# Product quantization.
+# To reduce the memory needed to serve the embeddings, we split each (normalized) target embedding
+# into n_sub sub-vectors, and replace each sub-vector by the index of the closest of n_centroids
+# centroids in that subspace. With 256 centroids, each sub-vector is stored in a single byte.
+# When searching, we use asymmetric distance computation: the query is kept at full precision, and
+# we precompute its dot products with all centroids, so that the score of a word is a sum of table lookups.
+
+def blocked_nearest_centroid(vectors, centroids, block_size=1<<16):
+    # For each vector, finds the closest centroid in Euclidean distance.
+    # Since |x-c|^2 = |x|^2 - 2 x.c + |c|^2, we can find it with a matrix multiplication.
+    half_norms = 0.5 * (centroids ** 2).sum(axis=1)
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        out[start:start+block_size] = (vectors[start:start+block_size] @ centroids.T - half_norms).argmax(axis=1)
+    return out
+
+def kmeans(vectors, n_centroids, n_iter):
+    # Standard k-means, starting from randomly selected vectors. Empty clusters get a random vector instead.
+    centroids = vectors[np.random.permutation(len(vectors))[:n_centroids]].copy()
+    for _ in range(n_iter):
+        assignment = blocked_nearest_centroid(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=len(centroids))
+        empty = counts == 0
+        sums[empty] = vectors[np.random.randint(len(vectors), size=empty.sum())]
+        counts[empty] = 1
+        centroids = (sums / counts[:, None]).astype(np.float32)
+    return centroids
+
+class PQEmbeddings:
+
+    def __init__(self, codebooks, codes, words):
+        # codebooks: shape (nbr of sub-vectors, nbr of centroids, sub-vector dimension)
+        # codes: shape (voc size, nbr of sub-vectors)
+        self.codebooks = codebooks
+        self.codes = codes
+        self.words = list(words)
+        self.voc = { w:i for i, w in enumerate(self.words) }
+        self.block_size = 1<<16
+
+    @staticmethod
+    def from_model(model, n_sub=8, n_centroids=256, n_iter=20, n_train=65536):
+        return PQEmbeddings.build(*model_embeddings(model), n_sub, n_centroids, n_iter, n_train)
+
+    @staticmethod
+    def build(vectors, words, n_sub=8, n_centroids=256, n_iter=20, n_train=65536):
+        voc_size, emb_dim = vectors.shape
+        if emb_dim % n_sub != 0:
+            raise ValueError(f'The embedding dimension {emb_dim} is not divisible by {n_sub}')
+        if n_centroids > 256:
+            raise ValueError('At most 256 centroids are supported')
+        sub_dim = emb_dim // n_sub
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(voc_size, n_sub, sub_dim)
+        sample = vectors[np.random.permutation(voc_size)[:n_train]]
+        n_centroids = min(n_centroids, voc_size)
+
+        # Train one codebook per subspace, then encode all the words.
+        codebooks = np.stack([kmeans(np.ascontiguousarray(sample[:, m]), n_centroids, n_iter) for m in range(n_sub)])
+        codes = np.empty((voc_size, n_sub), dtype=np.uint8)
+        for m in range(n_sub):
+            codes[:, m] = blocked_nearest_centroid(np.ascontiguousarray(vectors[:, m]), codebooks[m])
+        return PQEmbeddings(codebooks, codes, words)
+
+    def reconstruct(self, ix):
+        # The approximate vectors for a list of word indices.
+        n_sub = self.codes.shape[1]
+        return self.codebooks[np.arange(n_sub), self.codes[ix]].reshape(len(ix), -1)
+
+    def search(self, queries, k):
+        # Finds the k highest-scoring words for each query using asymmetric distance computation.
+        # Returns arrays of scores and word indices, each of shape (nbr of queries, k).
+        queries = np.asarray(queries, dtype=np.float32)
+        n_sub, n_centroids, sub_dim = self.codebooks.shape
+        k = min(k, len(self.codes))
+
+        # The dot products between each query sub-vector and the centroids of that subspace.
+        # shape: (nbr of sub-vectors, nbr of queries, nbr of centroids)
+        tables = np.einsum('qmd,mcd->mqc', queries.reshape(len(queries), n_sub, sub_dim), self.codebooks)
+
+        # With many queries, the table lookups cost more than decoding each block of
+        # words once and computing the same scores with a matrix multiplication.
+        decode = len(queries) >= sub_dim
+
+        values = np.zeros((len(queries), 0), dtype=np.float32)
+        ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.codes), self.block_size):
+            codes = self.codes[start:start+self.block_size]
+            if decode:
+                scores = queries @ self.reconstruct(np.arange(start, start+len(codes))).T
+            else:
+                scores = tables[0][:, codes[:, 0]]
+                for m in range(1, n_sub):
+                    scores += tables[m][:, codes[:, m]]
+            block_ids = np.arange(start, start+len(codes))
+            values, ids = merge_topk(values, ids, scores, block_ids, k)
+        return values, ids
+
+    def nearest_neighbors(self, words, n_neighbors):
+        # The same as SGNSModel.nearest_neighbors, but using the compressed embeddings.
+        words_ix = [self.voc[w] for w in words]
+        values, ids = self.search(self.reconstruct(words_ix), n_neighbors+1)
+        out = []
+        for w_ix, ixs, vals in zip(words_ix, ids, values):
+            nbrs = [ (self.words[ix], float(val)) for ix, val in zip(ixs, vals) if ix != w_ix ]
+            out.append(nbrs[:n_neighbors])
+        return out
+
+    def cosine_similarity(self, word1, word2):
+        v1, v2 = self.reconstruct([self.voc[word1], self.voc[word2]])
+        return float(v1.dot(v2) / (np.linalg.norm(v1) * np.linalg.norm(v2)))
+
+    def nbytes(self):
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def save(self, filename):
+        np.savez(filename, codebooks=self.codebooks, codes=self.codes, words=np.array(self.words))
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        return PQEmbeddings(data['codebooks'], data['codes'], data['words'].tolist())
+
+# Int8 quantization.
+# A simpler way to compress the embeddings is to store each (normalized) row as 8-bit integers,
+# together with a scale factor for the row. This takes a quarter of the memory of float32.
+# We quantize a chunk of rows at a time, so we never need a second full-size float copy of the table.
+
+class Int8Embeddings:
+
+    def __init__(self, codes, scales, words):
+        # codes: int8, shape (voc size, emb dim)
+        # scales: float32, shape (voc size,)
+        self.codes = codes
+        self.scales = scales
+        self.words = list(words)
+        self.voc = { w:i for i, w in enumerate(self.words) }
+        self.block_size = 1<<16
+
+    @staticmethod
+    def from_model(model, chunk_size=1<<16):
+        weight = model.w.weight
+        voc_size, emb_dim = weight.shape
+        codes = np.empty((voc_size, emb_dim), dtype=np.int8)
+        scales = np.empty(voc_size, dtype=np.float32)
+        with torch.no_grad():
+            for start in range(0, voc_size, chunk_size):
+                chunk = nn.functional.normalize(weight[start:start+chunk_size].float(), dim=1).cpu().numpy()
+                codes[start:start+chunk_size], scales[start:start+chunk_size] = quantize_int8(chunk)
+        return Int8Embeddings(codes, scales, [model.ivoc[i] for i in range(voc_size)])
+
+    def reconstruct(self, ix):
+        return self.codes[ix].astype(np.float32) * self.scales[ix, None]
+
+    def search(self, queries, k):
+        # Finds the k highest-scoring words for each query. Returns arrays of scores
+        # and word indices, each of shape (nbr of queries, k).
+        # We use PyTorch for the scoring, since its top-k is faster than NumPy's.
+        queries = torch.as_tensor(np.asarray(queries, dtype=np.float32), device='cpu')
+        k = min(k, len(self.codes))
+        values = torch.zeros((len(queries), 0), device='cpu')
+        ids = torch.zeros((len(queries), 0), dtype=torch.long, device='cpu')
+        with torch.no_grad():
+            for start in range(0, len(self.codes), self.block_size):
+                block = torch.from_numpy(self.codes[start:start+self.block_size])
+                # The row scales can be applied after the matrix multiplication.
+                scores = queries.mm(block.float().t()) * torch.from_numpy(self.scales[start:start+len(block)])
+                block_top = scores.topk(min(k, len(block)), dim=1)
+                values = torch.cat([values, block_top.values], dim=1)
+                ids = torch.cat([ids, block_top.indices + start], dim=1)
+                top = values.topk(k, dim=1)
+                values = top.values
+                ids = ids.gather(1, top.indices)
+        return values.numpy(), ids.numpy()
+
+    def nearest_neighbors(self, words, n_neighbors):
+        # The same as SGNSModel.nearest_neighbors, but using the quantized embeddings.
+        words_ix = [self.voc[w] for w in words]
+        values, ids = self.search(self.reconstruct(words_ix), n_neighbors+1)
+        out = []
+        for w_ix, ixs, vals in zip(words_ix, ids, values):
+            nbrs = [ (self.words[ix], float(val)) for ix, val in zip(ixs, vals) if ix != w_ix ]
+            out.append(nbrs[:n_neighbors])
+        return out
+
+    def cosine_similarity(self, word1, word2):
+        v1, v2 = self.reconstruct([self.voc[word1], self.voc[word2]])
+        return float(v1.dot(v2) / (np.linalg.norm(v1) * np.linalg.norm(v2)))
+
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def save(self, filename):
+        np.savez(filename, codes=self.codes, scales=self.scales, words=np.array(self.words))
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        return Int8Embeddings(data['codes'], data['scales'], data['words'].tolist())
+
+def quantize_int8(vectors):
+    # Quantizes each row to integers between -127 and 127, scaled by the largest absolute value in the row.
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+# Binary embeddings.
+# For a first, fast filtering step, we can keep just the sign of each dimension, packed into
+# 64-bit integers. The number of differing bits (the Hamming distance) between two such codes
+# approximates the angle between the original vectors. We find a shortlist of candidates with
+# the smallest Hamming distances, and then re-rank the shortlist by cosine similarity, using the
+# int8-quantized embeddings (so the whole representation takes about 1/4 of the float32 table, plus 1 bit
+# per dimension). The shortlist only works well if the embeddings have clear structure, as trained
+# embeddings do: for random vectors, the signs say little about the nearest neighbors.
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    def popcount(x):
+        return POPCOUNT_TABLE[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+def pack_signs(vectors):
+    # Packs the signs of the vectors into uint64 words, padding with zeros.
+    bits = np.packbits(vectors > 0, axis=1)
+    n_bytes = (bits.shape[1] + 7) // 8 * 8
+    padded = np.zeros((len(bits), n_bytes), dtype=np.uint8)
+    padded[:, :bits.shape[1]] = bits
+    return padded.view(np.uint64)
+
+class BinaryEmbeddings:
+
+    def __init__(self, bits, codes, scales, words, shortlist_factor=10):
+        # bits: the packed signs, uint64 of shape (voc size, nbr of words per vector)
+        # codes, scales: the int8-quantized normalized embeddings, used to re-rank the shortlist
+        # The shortlist for k neighbors contains shortlist_factor * k candidates.
+        self.bits = bits
+        self.codes = codes
+        self.scales = scales
+        self.words = list(words)
+        self.voc = { w:i for i, w in enumerate(self.words) }
+        self.shortlist_factor = shortlist_factor
+
+    @staticmethod
+    def from_model(model, chunk_size=1<<16, shortlist_factor=10):
+        vectors, words = model_embeddings(model)
+        bits = np.concatenate([pack_signs(vectors[start:start+chunk_size]) for start in range(0, len(vectors), chunk_size)])
+        codes, scales = quantize_int8(vectors)
+        return BinaryEmbeddings(bits, codes, scales, words, shortlist_factor)
+
+    def vectors(self, ix):
+        # Decodes the quantized embeddings of some words.
+        return self.codes[ix].astype(np.float32) * self.scales[ix][..., None]
+
+    def hamming_search(self, query_bits, k):
+        # Finds the k words with the smallest Hamming distances to each query.
+        # Returns arrays of distances and word indices, each of shape (nbr of queries, k).
+        n_queries, n_words = query_bits.shape
+        k = min(k, len(self.bits))
+        # We limit the size of the intermediate (queries, block, words) array to about 32 MB.
+        block_size = max(1, (1<<25) // (8 * n_words * n_queries))
+        values = np.zeros((n_queries, 0), dtype=np.int64)
+        ids = np.zeros((n_queries, 0), dtype=np.int64)
+        for start in range(0, len(self.bits), block_size):
+            block = self.bits[start:start+block_size]
+            dists = popcount(query_bits[:, None, :] ^ block[None, :, :]).sum(axis=2, dtype=np.int64)
+            # merge_topk keeps the highest values, so we use negative distances.
+            values, ids = merge_topk(values, ids, -dists, np.arange(start, start+len(block)), k)
+        return -values, ids
+
+    def search(self, queries, k):
+        # Finds the k most similar words for each (normalized) query: first a shortlist by Hamming
+        # distance, then re-ranked by cosine similarity. Returns arrays of scores and word indices.
+        queries = np.asarray(queries, dtype=np.float32)
+        _, shortlist = self.hamming_search(pack_signs(queries), self.shortlist_factor * k)
+        scores = np.einsum('qd,qkd->qk', queries, self.vectors(shortlist))
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(scores, top, axis=1), np.take_along_axis(shortlist, top, axis=1)
+
+    def nearest_neighbors(self, words, n_neighbors):
+        # The same as SGNSModel.nearest_neighbors, but searching by Hamming distance first.
+        words_ix = [self.voc[w] for w in words]
+        values, ids = self.search(self.vectors(words_ix), n_neighbors+1)
+        out = []
+        for w_ix, ixs, vals in zip(words_ix, ids, values):
+            nbrs = [ (self.words[ix], float(val)) for ix, val in zip(ixs, vals) if ix != w_ix ]
+            out.append(nbrs[:n_neighbors])
+        return out
+
+    def cosine_similarity(self, word1, word2):
+        v1, v2 = self.vectors([self.voc[word1], self.voc[word2]])
+        return float(v1.dot(v2))
+
+    def nbytes(self):
+        # The sign bits and the quantized embeddings for re-ranking.
+        return self.bits.nbytes + self.codes.nbytes + self.scales.nbytes
+
+def benchmark_compressed_embeddings(model, compressed, n_queries=100, k=10):
+    # Compares compressed embeddings to the full model: memory, query latency,
+    # and the overlap between the nearest neighbor lists.
+    words = [model.ivoc[i] for i in np.random.randint(len(model.voc), size=n_queries)]
+    full_bytes = model.w.weight.numel() * model.w.weight.element_size() + model.c.weight.numel() * model.c.weight.element_size()
+
+    t0 = time.time()
+    exact = model.nearest_neighbors(words, k)
+    t1 = time.time()
+    approx = compressed.nearest_neighbors(words, k)
+    t2 = time.time()
+
+    overlap = sum(len(set(w for w, _ in e) & set(w for w, _ in a)) for e, a in zip(exact, approx)) / (k * n_queries)
+
+    # The average error in the cosine similarity of random pairs of words.
+    pairs = zip(words, [model.ivoc[i] for i in np.random.randint(len(model.voc), size=n_queries)])
+    sim_error = np.mean([abs(model.cosine_similarity(w1, w2) - compressed.cosine_similarity(w1, w2)) for w1, w2 in pairs])
+
+    print(f'Full model: {full_bytes/(1<<20):.1f} MB, {1000*(t1-t0)/n_queries:.2f} ms/query')
+    print(f'Compressed: {compressed.nbytes()/(1<<20):.1f} MB, {1000*(t2-t1)/n_queries:.2f} ms/query, neighbor overlap@{k}: {overlap:.3f}, mean similarity error: {sim_error:.4f}')
+
+# Serving the embeddings.
+# A small asyncio HTTP server (on TCP or a Unix socket) with the endpoints /vector, /similarity,
+# /neighbors and /analogy, which take JSON requests such as {"word": "apple", "k": 5}, and /metrics.
+# Concurrent requests to the same endpoint are collected into micro-batches: a batch is run when it
+# has max_batch requests, or max_wait seconds after its first request arrived. Each batch is then
+# answered with a single call to the model's batched methods, in a separate thread so that the
+# server keeps accepting requests. Each request is validated before it joins a batch, so that a bad
+# request gets its own error (400) instead of failing the whole batch. Unknown words give a 404.
+
+class RequestBatcher:
+
+    def __init__(self, run_batch, executor, max_batch, max_wait):
+        # run_batch takes a list of requests and returns a list of results (or exceptions).
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.batch_sizes = deque(maxlen=10000)
+
+    async def submit(self, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [r for r, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+class EmbeddingServer:
+
+    def __init__(self, model, max_batch=256, max_wait=0.002):
+        self.model = model
+        # All model computations run in the same thread, one batch at a time.
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        handlers = {
+            'vector': self.run_vectors,
+            'similarity': self.run_similarities,
+            'neighbors': self.run_neighbors,
+            'analogy': self.run_analogies,
+        }
+        self.batchers = { name: RequestBatcher(f, self.executor, max_batch, max_wait) for name, f in handlers.items() }
+        # The words each endpoint needs.
+        self.word_fields = {
+            'vector': ['word'],
+            'similarity': ['word1', 'word2'],
+            'neighbors': ['word'],
+            'analogy': ['a', 'b', 'c'],
+        }
+        self.latencies = { name: deque(maxlen=10000) for name in handlers }
+        self.counts = Counter()
+        self.t_start = time.time()
+
+    def validate(self, name, request):
+        # Checks a single request; raises ValueError if it is malformed.
+        if not isinstance(request, dict):
+            raise ValueError('The request must be a JSON object')
+        for field in self.word_fields[name]:
+            if field not in request:
+                raise ValueError(f'Missing field: {field}')
+            if not isinstance(request[field], str):
+                raise ValueError(f'The field {field} must be a string')
+        k = request.get('k', 1)
+        if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+            raise ValueError('The field k must be a positive integer')
+        if request.get('method', 'add') not in ('add', 'mul'):
+            raise ValueError('The field method must be "add" or "mul"')
+
+    def word_ix(self, word):
+        if word not in self.model.voc:
+            raise KeyError(f'Unknown word: {word}')
+        return self.model.voc[word]
+
+    def run_vectors(self, requests):
+        out = []
+        for r in requests:
+            try:
+                out.append(self.word_ix(r['word']))
+            except Exception as e:
+                out.append(e)
+        ix = [ i for i in out if not isinstance(i, Exception) ]
+        with torch.inference_mode():
+            vectors = iter(self.model.w.weight[torch.as_tensor(ix, dtype=torch.long)].tolist())
+        return [ i if isinstance(i, Exception) else next(vectors) for i in out ]
+
+    def run_similarities(self, requests):
+        sims, _ = self.model.cosine_similarities([ (r['word1'], r['word2']) for r in requests ])
+        return [ KeyError('Unknown word') if np.isnan(s) else float(s) for s in sims ]
+
+    def run_neighbors(self, requests):
+        out = []
+        for r in requests:
+            try:
+                out.append(self.word_ix(r['word']))
+            except Exception as e:
+                out.append(e)
+        ix = [ i for i in out if not isinstance(i, Exception) ]
+        if not ix:
+            return out
+        # One search for the whole batch, with the largest k that was asked for.
+        k = max(r.get('k', 10) for r, i in zip(requests, out) if not isinstance(i, Exception))
+        all_emb = self.model.normalized_embeddings()
+        values, indices = self.model.search(all_emb[torch.as_tensor(ix, dtype=torch.long).to(all_emb.device)], k+1)
+        results = iter(zip(indices.tolist(), values.tolist()))
+        for j, (r, i) in enumerate(zip(requests, out)):
+            if isinstance(i, Exception):
+                continue
+            ixs, vals = next(results)
+            out[j] = [ (self.model.ivoc[n], v) for n, v in zip(ixs, vals) if n != i ][:r.get('k', 10)]
+        return out
+
+    def run_analogies(self, requests):
+        out = [None] * len(requests)
+        for method in set(r.get('method', 'add') for r in requests):
+            group = [ j for j, r in enumerate(requests) if r.get('method', 'add') == method ]
+            k = max(requests[j].get('k', 1) for j in group)
+            try:
+                answers = self.model.analogies([ (requests[j]['a'], requests[j]['b'], requests[j]['c']) for j in group ], k, method)
+            except Exception as e:
+                answers = [e] * len(group)
+            for j, a in zip(group, answers):
+                if a is None:
+                    out[j] = KeyError('Unknown word')
+                elif isinstance(a, Exception):
+                    out[j] = a
+                else:
+                    out[j] = a[:requests[j].get('k', 1)]
+        return out
+
+    def metrics(self):
+        elapsed = time.time() - self.t_start
+        out = {}
+        for name, lat in self.latencies.items():
+            sizes = self.batchers[name].batch_sizes
+            out[name] = {
+                'requests': self.counts[name],
+                'requests/sec': self.counts[name] / elapsed,
+                'p50 ms': 1000 * float(np.percentile(lat, 50)) if lat else None,
+                'p99 ms': 1000 * float(np.percentile(lat, 99)) if lat else None,
+                'mean batch size': float(np.mean(sizes)) if sizes else None,
+            }
+        return out
+
+    async def handle_request(self, method, path, body):
+        # Returns the HTTP status and the JSON response.
+        name = path.strip('/')
+        if name == 'metrics':
+            return 200, self.metrics()
+        if name not in self.batchers:
+            return 404, {'error': f'Unknown endpoint: {path}'}
+        t0 = time.time()
+        try:
+            request = json.loads(body or b'{}')
+            self.validate(name, request)
+            result = await self.batchers[name].submit(request)
+            status, response = 200, {'result': result}
+        except KeyError as e:
+            status, response = 404, {'error': str(e.args[0]) if e.args else 'Unknown word'}
+        except Exception as e:
+            status, response = 400, {'error': repr(e)}
+        self.latencies[name].append(time.time() - t0)
+        self.counts[name] += 1
+        return status, response
+
+    async def handle_connection(self, reader, writer):
+        # A minimal HTTP/1.1 implementation, with keep-alive.
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.handle_request(method, path, body)
+                data = json.dumps(response).encode('utf-8')
+                writer.write(f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+                             f'Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000, unix_path=None):
+        for batcher in self.batchers.values():
+            asyncio.ensure_future(batcher.run())
+        if unix_path:
+            return await asyncio.start_unix_server(self.handle_connection, unix_path)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+def serve(model, params, host='127.0.0.1', port=8000, unix_path=None):
+    # Runs the server until interrupted.
+    server = EmbeddingServer(model, params.get('server-max-batch', 256), params.get('server-max-wait', 0.002))
+    async def run():
+        s = await server.start(host, port, unix_path)
+        print(f'Serving on {unix_path or f"{host}:{port}"}')
+        async with s:
+            await s.serve_forever()
+    asyncio.run(run())
+
+def start_server_thread(model, params, host='127.0.0.1', port=0):
+    # Starts the server in a background thread, e.g. for testing. With port 0, a free port is chosen.
+    # Returns the server and the port it listens on.
+    server = EmbeddingServer(model, params.get('server-max-batch', 256), params.get('server-max-wait', 0.002))
+    loop = asyncio.new_event_loop()
+    started = concurrent.futures.Future()
+    def run():
+        asyncio.set_event_loop(loop)
+        s = loop.run_until_complete(server.start(host, port))
+        started.set_result(s.sockets[0].getsockname()[1])
+        loop.run_forever()
+    threading.Thread(target=run, daemon=True).start()
+    return server, started.result()
+
+def query_server(port, endpoint, payload, host='127.0.0.1'):
+    # Sends a request to the server and returns the status and the decoded JSON response.
+    conn = http.client.HTTPConnection(host, port)
+    try:
+        conn.request('POST', '/' + endpoint, json.dumps(payload), {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+# Reading the embeddings without PyTorch.
+# For inference processes, we can export the target embeddings as a NumPy matrix (float32 or float16)
+# with the vocabulary and the row norms in separate files:
+# - path.vectors.npy: the embeddings
+# - path.norms.npy: the length of each embedding (float32)
+# - path.vocab: the words, one per line, in the same order as the rows
+# EmbeddingReader (in embedding_reader.py) memory-maps these files, so it starts quickly, and the operating
+# system shares the pages between all processes that read the same files. It only uses NumPy, so it can be
+# used in processes that don't have PyTorch installed.
+
+def export_embeddings(model, path, dtype='float32', chunk_size=1<<16):
+    weight = model.w.weight
+    voc_size, emb_dim = weight.shape
+    vectors = np.lib.format.open_memmap(path + '.vectors.npy', mode='w+', dtype=dtype, shape=(voc_size, emb_dim))
+    norms = np.lib.format.open_memmap(path + '.norms.npy', mode='w+', dtype=np.float32, shape=(voc_size,))
+    # We copy the embeddings a chunk at a time, so we don't need a second copy of the whole table.
+    with torch.no_grad():
+        for start in range(0, voc_size, chunk_size):
+            chunk = weight[start:start+chunk_size].float().cpu().numpy()
+            vectors[start:start+chunk_size] = chunk
+            # We compute the norms from the stored values, in case they were rounded to float16.
+            norms[start:start+chunk_size] = np.linalg.norm(vectors[start:start+chunk_size].astype(np.float32), axis=1)
+    vectors.flush()
+    norms.flush()
+    with open(path + '.vocab', 'w', encoding='utf-8') as f:
+        for i in range(voc_size):
+            print(model.ivoc[i], file=f)
+
+# Exchanging embeddings in the word2vec formats.
+# Both formats start with a line containing the number of words and the dimension. In the text format,
+# each following line contains a word and its vector. In the binary format, each word is followed by a
+# space and the raw little-endian floats, and then a newline. We also allow float16 instead of float32 in
+# the binary format to halve the size; other tools can't read that, so it's not the default.
+# Everything is processed in chunks of rows, so we never need a second copy of the whole table.
+
+def save_word2vec(model, filename, binary=True, dtype=np.float32, chunk_size=1<<14):
+    weight = model.w.weight
+    voc_size, emb_dim = weight.shape
+    dtype = np.dtype(dtype).newbyteorder('<')
+    fmt = ' '.join(['%.6f'] * emb_dim)
+    with open(filename, 'wb', buffering=1<<22) as f:
+        f.write(f'{voc_size} {emb_dim}\n'.encode('utf-8'))
+        with torch.no_grad():
+            for start in range(0, voc_size, chunk_size):
+                chunk = weight[start:start+chunk_size].float().cpu().numpy()
+                words = [ model.ivoc[i] for i in range(start, start+len(chunk)) ]
+                if binary:
+                    rows = chunk.astype(dtype).tobytes()
+                    row_size = emb_dim * dtype.itemsize
+                    f.write(b''.join(w.encode('utf-8') + b' ' + rows[i*row_size:(i+1)*row_size] + b'\n'
+                                     for i, w in enumerate(words)))
+                else:
+                    f.write(''.join(w + ' ' + (fmt % tuple(row)) + '\n' for w, row in zip(words, chunk.tolist())).encode('utf-8'))
+
+def read_word2vec(filename, binary=True, dtype=np.float32, chunk_size=1<<14):
+    # Reads a file in the word2vec format, and yields (list of words, float32 matrix) for each chunk of rows.
+    dtype = np.dtype(dtype).newbyteorder('<')
+    with open(filename, 'rb', buffering=1<<22) as f:
+        voc_size, emb_dim = map(int, f.readline().split())
+        if not binary:
+            words = []
+            rows = []
+            for line in f:
+                t = line.rstrip().split(b' ')
+                if len(t) < emb_dim + 1:
+                    continue
+                words.append(t[0].decode('utf-8'))
+                rows.append(t[1:emb_dim+1])
+                if len(words) == chunk_size:
+                    yield words, np.array(rows, dtype=np.float32)
+                    words, rows = [], []
+            if words:
+                yield words, np.array(rows, dtype=np.float32)
+            return
+
+        # In the binary format, we read large blocks of bytes and find the words in them.
+        row_size = emb_dim * dtype.itemsize
+        buf = b''
+        pos = 0
+        n_read = 0
+        while n_read < voc_size:
+            words = []
+            chunk = np.empty((min(chunk_size, voc_size - n_read), emb_dim), dtype=np.float32)
+            for i in range(len(chunk)):
+                while True:
+                    # Skip the newline after the previous vector.
+                    while pos < len(buf) and buf[pos:pos+1] in (b'\n', b'\r'):
+                        pos += 1
+                    space = buf.find(b' ', pos)
+                    if space >= 0 and space + 1 + row_size <= len(buf):
+                        break
+                    more = f.read(1<<22)
+                    if not more:
+                        raise ValueError(f'Unexpected end of file in {filename}')
+                    buf = buf[pos:] + more
+                    pos = 0
+                words.append(buf[pos:space].decode('utf-8'))
+                chunk[i] = np.frombuffer(buf, dtype=dtype, count=emb_dim, offset=space+1)
+                pos = space + 1 + row_size
+            n_read += len(chunk)
+            yield words, chunk
+
+def warm_start_model(model, filename, binary=True, dtype=np.float32, chunk_size=1<<14):
+    # Initializes the target embeddings of the words in the model's vocabulary with the vectors
+    # from a word2vec file. Words that are not in the vocabulary are ignored.
+    n_found = 0
+    n_total = 0
+    with torch.no_grad():
+        for words, chunk in read_word2vec(filename, binary, dtype, chunk_size):
+            if chunk.shape[1] != model.w.weight.shape[1]:
+                raise ValueError(f'The vectors in {filename} have dimension {chunk.shape[1]}, but the model has {model.w.weight.shape[1]}')
+            n_total += len(words)
+            rows = [ (i, model.voc[w]) for i, w in enumerate(words) if w in model.voc ]
+            if rows:
+                src, dst = zip(*rows)
+                model.w.weight[torch.as_tensor(dst)] = torch.as_tensor(chunk[list(src)]).to(model.w.weight)
+                n_found += len(rows)
+    model.bump_version()
+    print(f'Warm start: found {n_found} of {len(model.voc)} vocabulary words among {n_total} vectors.')
+
+# Creating the optimizer.
+# With sparse gradients, we need an optimizer that only updates the rows that were used:
+# SparseAdam is a lazy version of Adam, and Adagrad and SGD handle sparse gradients directly.
+
+def make_optimizer(model, params):
+    optimizer = params['optimizer']
+    sparse = params.get('sparse', False)
+    if optimizer == 'adam':
+        if sparse:
+            raise ValueError('Adam does not support sparse gradients: use sparse-adam instead')
+        return torch.optim.Adam(model.parameters(), lr=params['lr'])
+    elif optimizer == 'sparse-adam':
+        if not sparse:
+            raise ValueError('SparseAdam requires sparse gradients')
+        return torch.optim.SparseAdam(list(model.parameters()), lr=params['lr'])
+    elif optimizer == 'adagrad':
+        return torch.optim.Adagrad(model.parameters(), lr=params['lr'])
+    elif optimizer == 'sgd':
+        return torch.optim.SGD(model.parameters(), lr=params['lr'])
+    raise ValueError(f'Unknown optimizer: {optimizer}')
+
+def benchmark_sparse_training(params, voc_sizes=(100000, 1000000, 5000000), n_steps=10):
+    # Compares the time per training step and the memory usage of dense and sparse training
+    # for different vocabulary sizes. The training pairs are just random word ids.
+    n_batch = params['batch-size']
+    n_ns = params['n-neg-samples']
+    loss_func = nn.BCEWithLogitsLoss()
+    y = torch.cat([torch.ones((n_batch, 1)), torch.zeros((n_batch, n_ns))], dim=1)
+    settings = [(False, 'adam'), (True, 'sparse-adam'), (False, 'adagrad'), (True, 'adagrad'), (False, 'sgd'), (True, 'sgd')]
+    for voc_size in voc_sizes:
+        voc = dict(zip(map(str, range(voc_size)), range(voc_size)))
+        for sparse, optimizer in settings:
+            bench_params = dict(params, sparse=sparse, optimizer=optimizer)
+            rss0 = current_rss_mb()
+            model = SGNSModel(voc, bench_params)
+            opt = make_optimizer(model, bench_params)
+            t0 = time.time()
+            for _ in range(n_steps):
+                t = torch.randint(voc_size, (n_batch,))
+                c = torch.randint(voc_size, (n_batch, 1 + n_ns))
+                opt.zero_grad()
+                loss = loss_func(model(t, c), y)
+                loss.backward()
+                opt.step()
+            t1 = time.time()
+            rss1 = current_rss_mb()
+            mode = 'sparse' if sparse else 'dense'
+            print(f'voc size {voc_size}, {mode} {optimizer}: {1000*(t1-t0)/n_steps:.1f} ms/step, RSS +{rss1-rss0:.0f} MB')
+            del model, opt
+
+# Prefetching batches.
+# Generating the training pairs and the negative samples doesn't depend on the model, so we can
+# do it in a background thread while the training step runs. The prepared batches are stored
+# in a bounded queue. To see which side is the bottleneck, we measure how long the producer waits
+# because the queue is full (the training step is slower) and how long the consumer waits because
+# the queue is empty (batch generation is slower).
+
+class BatchPrefetcher:
+
+    def __init__(self, batches, prepare, depth):
+        self.queue = queue_module.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.producer_stall = 0.0
+        self.consumer_stall = 0.0
+        self.thread = threading.Thread(target=self.produce, args=(batches, prepare), daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        # Waits until there is space in the queue, unless the consumer has stopped.
+        t0 = time.time()
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue_module.Full:
+                pass
+        self.producer_stall += time.time() - t0
+
+    def produce(self, batches, prepare):
+        try:
+            for t, c_pos in batches:
+                if self.stopped.is_set():
+                    return
+                self.put(('batch', prepare(t, c_pos)))
+            self.put(('end', None))
+        except Exception as e:
+            # Pass the error on to the training loop.
+            self.put(('error', e))
+
+    def __iter__(self):
+        try:
+            while True:
+                t0 = time.time()
+                kind, item = self.queue.get()
+                self.consumer_stall += time.time() - t0
+                if kind == 'end':
+                    return
+                if kind == 'error':
+                    raise item
+                yield item
+        finally:
+            self.stopped.set()
+
+    def print_stalls(self):
+        print(f'Prefetching: generator waited {self.producer_stall:.2f} s, trainer waited {self.consumer_stall:.2f} s')
+
+# Training metrics.
+# To see where the time goes, we measure the time spent in each processing stage, and count the words,
+# pairs and batches. The generator stages may run in the prefetching thread, so their times can overlap
+# with the training stages. On a GPU, the operations run asynchronously, so their time is mostly
+# attributed to the stage where we wait for the results.
+
+TRAINING_STAGES = ['read', 'subsample', 'pairs', 'negative-sampling', 'tensors', 'forward', 'backward', 'optimizer']
+
+class StageTimer:
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.stage, time.perf_counter() - self.t0)
+
+class TrainingMetrics:
+
+    def __init__(self, filename=None):
+        # Where to write the records as JSON lines (or None).
+        self.filename = filename
+        self.timers = {}
+        self.start_epoch(0)
+
+    def start_epoch(self, epoch, words=0):
+        # Resets the timers and counters. If we continue in the middle of an epoch,
+        # words is the number of words that were processed before.
+        self.epoch = epoch
+        self.stage_times = dict.fromkeys(TRAINING_STAGES, 0.0)
+        self.start_words = words
+        self.pairs = 0
+        self.batches = 0
+        self.t_start = time.perf_counter()
+
+    def timer(self, stage):
+        # Returns a context manager that measures the time spent in a stage.
+        if stage not in self.timers:
+            self.timers[stage] = StageTimer(self, stage)
+        return self.timers[stage]
+
+    def add(self, stage, seconds):
+        self.stage_times[stage] = self.stage_times.get(stage, 0.0) + seconds
+
+    def count_batch(self, n_pairs):
+        self.pairs += n_pairs
+        self.batches += 1
+
+    def record(self, words, **extra):
+        # Returns the current counters, rates and stage times as a dictionary.
+        elapsed = max(time.perf_counter() - self.t_start, 1e-9)
+        words -= self.start_words
+        return dict({
+            'epoch': self.epoch + 1,
+            'time': round(elapsed, 3),
+            'words': words,
+            'pairs': self.pairs,
+            'batches': self.batches,
+            'words/s': round(words / elapsed, 1),
+            'pairs/s': round(self.pairs / elapsed, 1),
+            'batches/s': round(self.batches / elapsed, 3),
+            'stages': { stage: round(t, 4) for stage, t in self.stage_times.items() },
+        }, **extra)
+
+    def write(self, record):
+        if self.filename:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def print_summary(self, record):
+        print(f'Epoch {record["epoch"]} summary: {record["time"]:.2f} s, {record["words"]} words ({record["words/s"]:.0f}/s), '
+              f'{record["pairs"]} pairs ({record["pairs/s"]:.0f}/s), {record["batches"]} batches ({record["batches/s"]:.2f}/s)')
+        for stage, t in record['stages'].items():
+            print(f' {stage:18} {t:9.2f} s {100 * t / record["time"]:6.1f}%')
+
+# Checkpoints.
+# We periodically save everything we need to continue training after a crash: the model, the optimizer state,
+# the epoch, the random number generator states, and where the generator is in the corpus.
+# To avoid blocking the training for long, we only copy the state in the training loop, and then write it
+# in a background thread. The file is written under a temporary name and then renamed, so a crash while
+# writing leaves the previous checkpoint intact.
+
+def snapshot(obj):
+    # Copies a nested structure of dicts, lists and tuples, moving the tensors to the CPU.
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return { k: snapshot(v) for k, v in obj.items() }
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+class CheckpointWriter:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread = None
+        self.error = None
+        self.n_written = 0
+        self.write_time = 0.0
+        self.stall = 0.0
+
+    def save(self, state):
+        # Copies the state and starts writing it. If the previous checkpoint is still being written,
+        # we wait for it first. The waiting and copying is the time the training is stalled.
+        t0 = time.time()
+        self.wait()
+        state = snapshot(state)
+        stall = time.time() - t0
+        self.stall += stall
+        self.thread = threading.Thread(target=self.write, args=(state, stall), daemon=True)
+        self.thread.start()
+
+    def write(self, state, stall):
+        try:
+            t0 = time.time()
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'wb') as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+            # Make sure the rename itself survives a crash.
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            write_time = time.time() - t0
+            self.write_time += write_time
+            self.n_written += 1
+            print(f'Checkpoint saved to {self.filename}: write time {write_time:.2f} s, training stalled {stall:.3f} s')
+        except Exception as e:
+            # Pass the error on to the training loop.
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def print_summary(self):
+        print(f'Checkpoints: {self.n_written} written, total write time {self.write_time:.2f} s, total training stall {self.stall:.3f} s')
 
 # NEXT STEP IS TRAINING
 # The following calss contains the training loop: it creates  a batch of positive target-context pairs, generates negative samples,
@@ -292,20 +2588,24 @@ class SGNSTrainer:
         n_batch = params['batch-size']
         self.n_ns = params['n-neg-samples']
 
-        if params['optimizer'] == 'adam':
-            self.optimizer = torch.optim.Adam(self.model.parameters(), lr=params['lr'])
-        elif params['optimizer'] == 'sgd':
-            self.optimizer = torch.optim.SGD(self.model.parameters(), lr=params['lr'])
+        self.optimizer = make_optimizer(self.model, params)
+
+        # Timings and counters, which we share with the generator so that it can time its stages too.
+        self.metrics = TrainingMetrics(params.get('metrics-file'))
+        if hasattr(instance_gen, 'metrics'):
+            instance_gen.metrics = self.metrics
 
         # We'll use a binary cross-entropy loss, since we have a binary classification problem:
         # distinguishing positive from negative contexts.
         self.loss = nn.BCEWithLogitsLoss()
 
-        # Build the negative sampling table.
-        ns_table_expanded = []
-        for i, (_, _, count) in enumerate(ns_table):
-            ns_table_expanded.extend([i] * count)
-        self.ns_table = torch.as_tensor(ns_table_expanded)
+        # Build the negative sampler. By default, we use the alias method; the old
+        # expanded table can still be selected with 'ns-sampler': 'table'.
+        if params.get('ns-sampler', 'alias') == 'table':
+            self.ns_table = make_expanded_ns_table(ns_table)
+            self.ns_sampler = None
+        else:
+            self.ns_sampler = AliasSampler(ns_table, params.get('ns-exp'))
         
         # Define the "gold standard" that we'll use to compute the loss.
         # It consists of a column of ones, and then a number of columns of zeros.
@@ -320,7 +2620,18 @@ class SGNSTrainer:
         self.testwords = params['testwords']
         self.n_testwords_neighbors = params['n-testwords-neighbors']
 
+        # How many batches to prepare in advance (0 means no prefetching).
+        self.prefetch = params.get('prefetch-depth', 0)
+
+        # Where and how often (in seconds) to save checkpoints, and whether to continue from an existing checkpoint.
+        self.checkpoint_file = params.get('checkpoint-file')
+        self.checkpoint_interval = params.get('checkpoint-interval', 600)
+        self.resume = params.get('resume', False)
+
         self.epoch = 0
+
+        # Where the generator should continue after the last batch we trained on (None at the start of an epoch).
+        self.position = None
         
     def print_test_nearest_neighbors(self):
                 
@@ -336,70 +2647,295 @@ class SGNSTrainer:
         print('------------------------------------')
         
     def make_negative_sample(self, batch_size):
+        if self.ns_sampler is not None:
+            return self.ns_sampler.sample((batch_size, self.n_ns))
         neg_sample_ixs = torch.randint(len(self.ns_table), (batch_size, self.n_ns))
         return self.ns_table.take(neg_sample_ixs)
             
+    def train_step(self, t, c_pos):
+        # Carries out one update for a batch of positive pairs, and returns the loss.
+        return self.update(*self.prepare_batch(t, c_pos))
+
+    def prepare_batch(self, t, c_pos):
+        # Converts a batch of positive pairs into tensors and adds the negative samples.
+        batch_size = len(t)
+        
+        # Put the encoded target words and contexts into PyTorch tensors.
+        with self.metrics.timer('tensors'):
+            t = torch.as_tensor(t)                
+            c_pos = torch.as_tensor(c_pos)
+            c_pos = c_pos.view(batch_size, 1)
+        
+        # Generate a sample of fake context words.
+        # shape: (batch size, number of negative samples)
+        with self.metrics.timer('negative-sampling'):
+            c_neg = self.make_negative_sample(batch_size)
+        
+        # Combine positive and negative contexts.
+        # shape: (batch size, 1 + nbr neg samples)
+        with self.metrics.timer('tensors'):
+            c = torch.cat([c_pos, c_neg], dim=1)
+        return t, c
+
+    def update(self, t, c):
+        # Carries out one update for a prepared batch, and returns the loss.
+        batch_size = len(t)
+        with self.metrics.timer('optimizer'):
+            self.optimizer.zero_grad()
+
+        with self.metrics.timer('forward'):
+            # Compute the output from the model.
+            # That is, the dot products between target embeddings
+            # and context embeddings.
+            scores = self.model(t, c)
+
+            # Compute the loss with respect to the gold standard.
+            loss = self.loss(scores, self.y[:batch_size])
+
+        # Compute gradients and update the embeddings.
+        with self.metrics.timer('backward'):
+            loss.backward()
+        with self.metrics.timer('optimizer'):
+            self.optimizer.step()
+            self.model.bump_version()
+        return loss.item()
+
+    def checkpoint_state(self):
+        return {
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'epoch': self.epoch,
+            'generator': self.position,
+            'generator-mode': getattr(self.instance_gen, 'position_mode', None),
+            'voc-size': self.model.w.weight.shape[0],
+            'emb-dim': self.model.w.weight.shape[1],
+            'torch-rng': torch.get_rng_state(),
+            'cuda-rng': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'numpy-rng': np.random.get_state(),
+        }
+
+    def load_checkpoint(self, filename):
+        state = torch.load(filename, map_location='cpu', weights_only=False)
+        voc_size, emb_dim = self.model.w.weight.shape
+        if (state['voc-size'], state['emb-dim']) != (voc_size, emb_dim):
+            raise ValueError(f'The checkpoint {filename} has vocabulary size {state["voc-size"]} and embedding dimension '
+                             f'{state["emb-dim"]}, but the model has {voc_size} and {emb_dim}')
+        if state['epoch'] >= self.n_epochs:
+            print(f'The checkpoint {filename} is from a finished run, so we start from the beginning.')
+            return
+        self.model.load_state_dict(state['model'])
+        self.model.bump_version()
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.epoch = state['epoch']
+        torch.set_rng_state(state['torch-rng'])
+        if state['cuda-rng'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['cuda-rng'])
+        np.random.set_state(state['numpy-rng'])
+
+        # Continue the epoch where we stopped, if the generator supports it and reads the corpus in the same way.
+        self.position = state['generator']
+        if self.position is not None:
+            if state['generator-mode'] == getattr(self.instance_gen, 'position_mode', None):
+                self.instance_gen.continue_from(self.position)
+                print(f'Continuing from checkpoint {filename}: epoch {self.epoch+1}, after {self.position[1]} words.')
+                return
+            print(f'The generator can\'t continue from this position, so we restart epoch {self.epoch+1}.')
+            self.position = None
+        print(f'Continuing from checkpoint {filename}: epoch {self.epoch+1}.')
+
     def train(self):
 
         print_interval = 5000000
+
+        # If there is a checkpoint, we continue from there.
+        writer = None
+        if self.checkpoint_file:
+            if self.resume and os.path.exists(self.checkpoint_file):
+                self.load_checkpoint(self.checkpoint_file)
+            writer = CheckpointWriter(self.checkpoint_file)
+
+        # To save checkpoints in the middle of an epoch, we need to know where the generator is.
+        positions = getattr(self.instance_gen, 'positions', None)
         
         while self.epoch < self.n_epochs:
             print(f'Epoch {self.epoch+1}.')
+            t_checkpoint = time.time()
 
             # For diagnostics.
             n_pairs = 0
             sum_loss = 0
             total_pairs = 0
             n_batches = 0
+            epoch_loss = 0
             t0 = time.time()
+            self.metrics.start_epoch(self.epoch, self.position[1] if self.position else 0)
             
-            for t, c_pos in self.instance_gen.batches():
-
-                batch_size = len(t)
-                
-                # Put the encoded target words and contexts into PyTorch tensors.
-                t = torch.as_tensor(t)                
-                c_pos = torch.as_tensor(c_pos)
-                c_pos = c_pos.view(batch_size, 1)
-                
-                # Generate a sample of fake context words.
-                # shape: (batch size, number of negative samples)
-                c_neg = self.make_negative_sample(batch_size)
-                
-                # Combine positive and negative contexts.
-                # shape: (batch size, 1 + nbr neg samples)
-                c = torch.cat([c_pos, c_neg], dim=1)
-                
-                self.optimizer.zero_grad()
+            # If we prefetch, the batches are prepared in a background thread while we train.
+            if self.prefetch > 0:
+                batches = BatchPrefetcher(self.instance_gen.batches(), self.prepare_batch, self.prefetch)
+            else:
+                batches = (self.prepare_batch(t, c_pos) for t, c_pos in self.instance_gen.batches())
 
-                # Compute the output from the model.
-                # That is, the dot products between target embeddings
-                # and context embeddings.
-                scores = self.model(t, c)
+            for t, c in batches:
 
-                # Compute the loss with respect to the gold standard.
-                loss = self.loss(scores, self.y[:batch_size])
+                batch_size = len(t)
+                loss = self.update(t, c)
+                if positions is not None:
+                    self.position = positions.popleft()
 
-                # Compute gradients and update the embeddings.
-                loss.backward()
-                self.optimizer.step()
+                if writer and positions is not None and time.time() - t_checkpoint > self.checkpoint_interval:
+                    writer.save(self.checkpoint_state())
+                    t_checkpoint = time.time()
 
                 # We'll print some diagnostics periodically.
-                sum_loss += loss.item()
+                sum_loss += loss
+                epoch_loss += loss
                 n_pairs += batch_size
                 n_batches += 1
+                self.metrics.count_batch(batch_size)
                 if n_pairs > print_interval:
                     total_words = self.instance_gen.word_count
                     total_pairs += n_pairs
                     t1 = time.time()                    
                     print(f'Pairs: {total_pairs}, words: {total_words}, loss: {sum_loss / n_batches:.4f}, time: {t1-t0:.2f}')
+                    self.metrics.write(self.metrics.record(total_words, loss=sum_loss / n_batches))
+                    if self.prefetch > 0:
+                        batches.print_stalls()
                     self.print_test_nearest_neighbors()
                     n_pairs = 0
                     sum_loss = 0
                     n_batches = 0
                     t0 = time.time()
+
+            if self.prefetch > 0:
+                batches.print_stalls()
+
+            record = self.metrics.record(self.instance_gen.word_count, loss=epoch_loss / max(self.metrics.batches, 1), **{'end-of-epoch': True})
+            self.metrics.write(record)
+            self.metrics.print_summary(record)
                     
             self.epoch += 1
+            self.position = None
+            if writer:
+                writer.save(self.checkpoint_state())
+
+        if writer:
+            writer.wait()
+            writer.print_summary()
+
+# Hogwild training.
+# The work in each training step is small, so a single process can't keep many cores busy.
+# Instead, we put the embeddings in shared memory and start several worker processes, each
+# of which reads its own shard of the corpus and updates the shared embeddings without locking.
+# Since the updates are sparse, workers rarely overwrite each other's changes.
+
+def hogwild_worker(worker_id, n_workers, instance_gen, model, ns_table, params, queue):
+    try:
+        torch.set_num_threads(params.get('threads-per-worker', 1))
+        # Make sure that the workers don't generate the same random numbers.
+        seed = params.get('seed', 0) * n_workers + worker_id
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+
+        # Each worker has its own optimizer, which updates the shared parameters.
+        instance_gen.set_shard(worker_id, n_workers)
+        trainer = SGNSTrainer(instance_gen, model, ns_table, params)
+        report_interval = params.get('report-interval', 10)
+
+        for epoch in range(trainer.n_epochs):
+            n_pairs = 0
+            n_batches = 0
+            sum_loss = 0
+            t0 = time.time()
+            for t, c_pos in instance_gen.batches():
+                sum_loss += trainer.train_step(t, c_pos)
+                n_pairs += len(t)
+                n_batches += 1
+                if n_batches % report_interval == 0:
+                    queue.put(('progress', worker_id, epoch, instance_gen.word_count, n_pairs, sum_loss / n_batches, time.time() - t0))
+            queue.put(('epoch', worker_id, epoch, instance_gen.word_count, n_pairs, sum_loss / max(n_batches, 1), time.time() - t0))
+        queue.put(('done', worker_id))
+    except Exception as e:
+        queue.put(('error', worker_id, repr(e)))
+        raise
+
+def train_hogwild(instance_gen, model, ns_table, params):
+    n_workers = params['hogwild-workers']
+    # The workers update the embeddings without locking, which only works if the updates are sparse,
+    # and CUDA can't be used in forked processes.
+    if model.w.weight.is_cuda:
+        raise ValueError('Hogwild training only works on the CPU')
+    if not params.get('sparse', False):
+        raise ValueError('Hogwild training requires sparse gradients (sparse: True, with sparse-adam, adagrad or sgd)')
+    model.share_memory()
+
+    # If we use the encoded corpus, we create it before starting the workers, so that they don't all encode it.
+    if instance_gen.cache_dir:
+        instance_gen.open_cache()
+
+    # We fork the workers, so that they can use functions defined in a notebook.
+    mp = torch.multiprocessing.get_context('fork')
+    queue = mp.Queue()
+    workers = [mp.Process(target=hogwild_worker, args=(i, n_workers, instance_gen, model, ns_table, params, queue))
+               for i in range(n_workers)]
+    for p in workers:
+        p.start()
+
+    # Collect the progress reports from the workers.
+    # For each worker, we store the latest report.
+    status = {}
+    running = set(range(n_workers))
+    print_interval = params.get('hogwild-print-interval', 10)
+    t_start = time.time()
+    t_print = t_start
+    total_words = 0
+    failures = []
+    while running:
+        try:
+            msg = queue.get(timeout=1)
+        except queue_module.Empty:
+            # Check if some worker died without telling us.
+            for i in list(running):
+                if not workers[i].is_alive():
+                    running.discard(i)
+                    failures.append(f'Worker {i} exited with code {workers[i].exitcode}')
+            continue
+        kind, worker_id = msg[0], msg[1]
+        if kind == 'done':
+            running.discard(worker_id)
+        elif kind == 'error':
+            running.discard(worker_id)
+            failures.append(f'Worker {worker_id} failed: {msg[2]}')
+        else:
+            status[worker_id] = msg
+            if kind == 'epoch':
+                epoch, words, pairs, loss, elapsed = msg[2:]
+                total_words += words
+                print(f'Worker {worker_id}, epoch {epoch+1}: words: {words}, pairs: {pairs}, loss: {loss:.4f}, {words/max(elapsed, 1e-9):.0f} words/sec')
+        if time.time() - t_print > print_interval:
+            t_print = time.time()
+            report_hogwild_progress(status, total_words, t_print - t_start)
+
+    for p in workers:
+        p.join()
+    # The workers have changed the shared embeddings.
+    model.bump_version()
+    failures += [ f'Worker {i} exited with code {p.exitcode}' for i, p in enumerate(workers)
+                  if p.exitcode != 0 and not any(f.startswith(f'Worker {i} ') for f in failures) ]
+    if failures:
+        raise RuntimeError('Hogwild training failed:\n' + '\n'.join(failures))
+    report_hogwild_progress(status, total_words, time.time() - t_start)
+
+def report_hogwild_progress(status, finished_words, elapsed):
+    # Prints the throughput of each worker, and the total throughput.
+    # The words in finished epochs have already been counted.
+    words_now = 0
+    for kind, worker_id, epoch, words, pairs, loss, worker_time in (status[i] for i in sorted(status)):
+        print(f' worker {worker_id}: epoch {epoch+1}, {words/max(worker_time, 1e-9):.0f} words/sec, loss: {loss:.4f}')
+        if kind == 'progress':
+            words_now += words
+    print(f'Total: {finished_words + words_now} words, {(finished_words + words_now)/elapsed:.0f} words/sec')
+    print('------------------------------------')
 
 # Putting pieces together
 
@@ -418,20 +2954,44 @@ def main():
         
         'batch-size': 1<<20, # Number of positive training instances in one batch
         'context-width': 5, # Maximal possible context width
+        'vectorized-pairs': True, # Whether to generate the training pairs with NumPy array operations
+        'chunk-lines': 10000, # Number of lines to process at a time when vectorized
+        'corpus-cache': 'corpus_cache', # Where to store the encoded corpus (None to always read the text)
+        'generator-workers': 1, # Number of processes generating the training pairs
+        'generator-order': 'ordered', # Whether to merge their batches in a fixed order ('ordered') or as they come ('unordered')
+        'generator-slots': 4, # Number of batches each generator process can have waiting
         'prune-threshold': 1e-3, # Pruning threshold (see Mikolov's paper)
+        'random-pool-size': 1<<20, # Number of random numbers for pruning to draw at a time
         'voc-size': 100000, # Maximal vocabulary size
-        'ns-table-file': 'ns_table.txt', # Where to store the negative sampling table
+        'workers': 1, # Number of processes for counting the vocabulary
+        'ns-table-file': 'ns_table.bin', # Where to store the negative sampling table (binary format if it ends with .bin)
         'ns-table-size': 1<<24, # Size of negative sampling table
+        'ns-sampler': 'alias', # Negative sampler: 'alias' (alias method) or 'table' (expanded table)
         'ns-exp': 0.75, # Smoothing parameter for negative sampling distribution (see paper)
         'unknown-str': '<UNKNOWN>', # Dummy token for low-frequency words
         'lowercase': True, # Whether to lowercase the text
-        'optimizer': 'adam', # Which gradient descent optimizer to use
+        'optimizer': 'adam', # Which gradient descent optimizer to use: adam, sparse-adam, adagrad or sgd
+        'sparse': False, # Whether to use sparse gradients for the embeddings (requires sparse-adam, adagrad or sgd)
         'lr': 1e-1, # Learning rate for the  optimizer
+        'prefetch-depth': 4, # Number of batches to prepare in a background thread (0 to disable)
+        'hogwild-workers': 1, # Number of Hogwild training processes (CPU only; use with sparse gradients)
+        'threads-per-worker': 1, # Number of PyTorch threads in each Hogwild worker
 
         # The test words for which we print the nearest neighbors periodically
         'testwords': ['apple', 'terrible', 'sweden', '1979', 'write', 'gothenburg'],
         # Number of nearest neighbors
         'n-testwords-neighbors': 5,
+        'nn-block-size': 1<<16, # Number of vocabulary rows to score at a time in nearest neighbor searches
+        'nn-query-block': 1024, # Number of query words to score at a time in nearest neighbor searches
+        'server-max-batch': 256, # Maximal number of requests the embedding server answers in one batch
+        'server-max-wait': 0.002, # Maximal time (in seconds) the server waits to fill a batch
+        'checkpoint-file': 'checkpoint.pt', # Where to save training checkpoints (None to disable)
+        'checkpoint-interval': 600, # Number of seconds between checkpoints within an epoch
+        'resume': False, # Whether to continue from the checkpoint if it exists
+        'metrics-file': 'metrics.jsonl', # Where to write the training metrics as JSON lines (None to disable)
+        'warm-start': None, # word2vec file (binary format) to initialize the embeddings from, or None
+        'export-word2vec': None, # Where to save the trained embeddings in the binary word2vec format, or None
+        'export-float16': False, # Whether to store 16-bit floats in the exported word2vec file
     }
     
     if params['device'] == 'cuda' and torch.cuda.is_available():
@@ -442,18 +3002,41 @@ def main():
         print('Running on CPU.')
 
     # If we didn't already create the vocabulary and negative 
-    # sampling table, we'll do that now.
+    # sampling table, we'll do that now. If we use the binary format but only have
+    # a table in the text format (ns_table.txt for ns_table.bin), we convert it.
+    binary_ns_table = params['ns-table-file'].endswith('.bin')
+    text_ns_table_file = params['ns-table-file'][:-len('.bin')] + '.txt'
     if os.path.exists(params['ns-table-file']):
-        ns_table = load_ns_table(params['ns-table-file'])
+        if binary_ns_table:
+            ns_table = load_ns_table_binary(params['ns-table-file'])
+        else:
+            ns_table = load_ns_table(params['ns-table-file'])
+    elif binary_ns_table and os.path.exists(text_ns_table_file):
+        print(f'Converting {text_ns_table_file} to the binary format.')
+        save_ns_table_binary(load_ns_table(text_ns_table_file), params['ns-table-file'])
+        ns_table = load_ns_table_binary(params['ns-table-file'])
     else:
         ns_table = make_ns_table(params)
-        save_ns_table(ns_table, params['ns-table-file'])
+        if binary_ns_table:
+            save_ns_table_binary(ns_table, params['ns-table-file'])
+        else:
+            save_ns_table(ns_table, params['ns-table-file'])
 
     ctx_gen = SGNSContextGenerator(ns_table, params)
+    if params['generator-workers'] > 1 and params['hogwild-workers'] <= 1:
+        ctx_gen = ParallelContextGenerator(ctx_gen, params)
     model = SGNSModel(ctx_gen.voc, params)
+    if params['warm-start']:
+        warm_start_model(model, params['warm-start'])
     trainer = SGNSTrainer(ctx_gen, model, ns_table, params)
 
-    trainer.train()
+    if params['hogwild-workers'] > 1:
+        train_hogwild(ctx_gen, model, ns_table, params)
+    else:
+        trainer.train()
+
+    if params['export-word2vec']:
+        save_word2vec(model, params['export-word2vec'], dtype=np.float16 if params['export-float16'] else np.float32)
         
 main()
 
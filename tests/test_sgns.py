@@ -0,0 +1,281 @@
+import os, subprocess, sys, tempfile, types, unittest
+import concurrent.futures
+
+import numpy as np
+
+# The implementation is exported from a notebook: it contains shell commands and
+# starts training when it is run. We load it without those parts.
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def load_sgns():
+    if 'sgns' in sys.modules:
+        return sys.modules['sgns']
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    filename = os.path.join(REPO_DIR, 'sgns_implementation.py')
+    lines = []
+    for line in open(filename, encoding='utf-8').read().split('\n'):
+        if line.startswith('!'):
+            continue
+        if line.strip() == 'main()':
+            break
+        lines.append(line)
+    module = types.ModuleType('sgns')
+    sys.modules['sgns'] = module
+    exec(compile('\n'.join(lines), filename, 'exec'), module.__dict__)
+    return module
+
+def make_params(tmpdir, **extra):
+    corpus = os.path.join(tmpdir, 'corpus.txt')
+    rng = np.random.RandomState(0)
+    with open(corpus, 'w') as f:
+        for _ in range(2000):
+            f.write(' '.join(f'w{i}' for i in rng.zipf(1.5, size=rng.randint(1, 25)) % 300) + '\n')
+    params = {
+        'corpus': corpus, 'voc-size': 200, 'ns-table-size': 1<<12, 'unknown-str': '<UNKNOWN>',
+        'lowercase': True, 'ns-exp': 0.75, 'batch-size': 512, 'context-width': 3, 'prune-threshold': 1e-3,
+        'n-neg-samples': 2, 'emb-dim': 8, 'n-epochs': 1, 'optimizer': 'sgd', 'sparse': False, 'lr': 0.1,
+        'testwords': [], 'n-testwords-neighbors': 3,
+    }
+    params.update(extra)
+    return params
+
+class NSTableTest(unittest.TestCase):
+
+    def test_parallel_counting_equals_serial(self):
+        sgns = load_sgns()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            params = make_params(tmpdir)
+            self.assertEqual(sgns.make_ns_table(dict(params, workers=3)), sgns.make_ns_table(params))
+
+    def test_binary_table(self):
+        sgns = load_sgns()
+        table = [ ('<UNKNOWN>', 40, 9), ('a', 30, 7), ('ö', 20, 5), ('bc', 10, 3) ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'ns_table.bin')
+            sgns.save_ns_table_binary(table, filename)
+            loaded = sgns.load_ns_table_binary(filename)
+            self.assertEqual(list(loaded), table)
+            self.assertEqual([ loaded[i] for i in range(len(table)) ], table)
+
+            # Change one byte of the frequencies.
+            with open(filename, 'rb') as f:
+                data = bytearray(f.read())
+            pos = sgns.ns_table_sections(len(table), 0)[1][0]
+            data[pos] ^= 1
+            with open(filename, 'wb') as f:
+                f.write(data)
+            with self.assertRaisesRegex(ValueError, 'Checksum error'):
+                sgns.load_ns_table_binary(filename)
+
+            sgns.save_ns_table(table, os.path.join(tmpdir, 'ns_table.txt'))
+            with self.assertRaisesRegex(ValueError, 'not a binary negative sampling table'):
+                sgns.load_ns_table_binary(os.path.join(tmpdir, 'ns_table.txt'))
+
+class AliasSamplerTest(unittest.TestCase):
+
+    def test_distribution_matches_table(self):
+        sgns = load_sgns()
+        import torch
+        torch.manual_seed(0)
+        ns_table = [ ('a', 50, 1), ('b', 30, 7), ('c', 10, 2), ('d', 5, 0), ('e', 1, 15), ('f', 20, 5) ]
+        counts = np.array([ c for _, _, c in ns_table ], dtype=np.float64)
+        n_draws = 2000000
+
+        samples = sgns.AliasSampler(ns_table).sample((n_draws,)).numpy()
+        observed = np.bincount(samples, minlength=len(ns_table)) / n_draws
+        np.testing.assert_allclose(observed, counts / counts.sum(), atol=2e-3)
+        self.assertEqual(observed[3], 0)
+
+        # With an exponent, the distribution is computed from the frequencies instead.
+        freqs = np.array([ f for _, f, _ in ns_table ], dtype=np.float64) ** 0.75
+        samples = sgns.AliasSampler(ns_table, 0.75).sample((n_draws,)).numpy()
+        observed = np.bincount(samples, minlength=len(ns_table)) / n_draws
+        np.testing.assert_allclose(observed, freqs / freqs.sum(), atol=2e-3)
+
+class PairGenerationTest(unittest.TestCase):
+
+    def test_vectorized_pairs_equal_loop(self):
+        sgns = load_sgns()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # With context width 1 and no pruning, the pairs don't depend on the random numbers.
+            params = make_params(tmpdir, **{'context-width': 1, 'prune-threshold': 10, 'chunk-lines': 37})
+            ns_table = sgns.make_ns_table(params)
+            loop = list(sgns.SGNSContextGenerator(ns_table, dict(params, **{'vectorized-pairs': False})).batches())
+            vectorized = list(sgns.SGNSContextGenerator(ns_table, dict(params, **{'vectorized-pairs': True})).batches())
+            self.assertEqual(len(loop), len(vectorized))
+            for (t1, c1), (t2, c2) in zip(loop, vectorized):
+                np.testing.assert_array_equal(t1, t2)
+                np.testing.assert_array_equal(c1, c2)
+
+class CorpusCacheTest(unittest.TestCase):
+
+    def test_cache_covers_whole_corpus_when_sharded(self):
+        sgns = load_sgns()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            params = make_params(tmpdir, **{'corpus-cache': os.path.join(tmpdir, 'cache')})
+            ns_table = sgns.make_ns_table(params)
+            gen = sgns.SGNSContextGenerator(ns_table, params)
+            gen.set_shard(1, 2)
+            for _ in gen.batches():
+                pass
+            _, offsets = gen.open_cache()
+            with open(params['corpus']) as f:
+                lengths = [len(line.split()) for line in f]
+            self.assertEqual(len(offsets) - 1, len(lengths))
+            self.assertEqual(offsets[-1], sum(lengths))
+
+    def test_cache_covers_whole_corpus_with_parallel_generator(self):
+        sgns = load_sgns()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            params = make_params(tmpdir, **{'corpus-cache': os.path.join(tmpdir, 'cache'), 'generator-workers': 2})
+            ns_table = sgns.make_ns_table(params)
+            gen = sgns.SGNSContextGenerator(ns_table, params)
+            for _ in sgns.ParallelContextGenerator(gen, params).batches():
+                pass
+            _, offsets = gen.open_cache()
+            with open(params['corpus']) as f:
+                lengths = [len(line.split()) for line in f]
+            self.assertEqual(len(offsets) - 1, len(lengths))
+            self.assertEqual(offsets[-1], sum(lengths))
+
+class EmbeddingServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        sgns = load_sgns()
+        cls.sgns = sgns
+        model = sgns.SGNSModel({ f'w{i}': i for i in range(100) }, {'emb-dim': 8})
+        # A long wait, so that concurrent requests end up in the same batch.
+        cls.server, cls.port = sgns.start_server_thread(model, {'server-max-wait': 0.2})
+
+    def query(self, endpoint, payload):
+        return self.sgns.query_server(self.port, endpoint, payload)
+
+    def test_unknown_words(self):
+        requests = [
+            ('vector', {'word': 'unknown'}),
+            ('similarity', {'word1': 'w1', 'word2': 'unknown'}),
+            ('neighbors', {'word': 'unknown', 'k': 3}),
+            ('analogy', {'a': 'w1', 'b': 'unknown', 'c': 'w2'}),
+            ('analogy', {'a': 'w1', 'b': 'unknown', 'c': 'w2', 'method': 'mul'}),
+        ]
+        for endpoint, payload in requests:
+            status, response = self.query(endpoint, payload)
+            self.assertEqual(status, 404, (endpoint, response))
+
+    def test_bad_request_does_not_fail_its_batch(self):
+        requests = [ ('similarity', {'word1': 'w1', 'word2': f'w{i}'}) for i in range(6) ]
+        requests.append(('similarity', {'word1': 'w1'}))
+        requests += [ ('neighbors', {'word': 'w1', 'k': 2}), ('neighbors', {'word': 'w2', 'k': 'many'}) ]
+        requests += [ ('analogy', {'a': 'w1', 'b': 'w2', 'c': 'w3'}), ('analogy', {'a': 'w1', 'b': 'w2'}),
+                      ('analogy', {'a': 'w1', 'b': 'w2', 'c': 'unknown'}) ]
+        with concurrent.futures.ThreadPoolExecutor(len(requests)) as executor:
+            statuses = [ status for status, _ in executor.map(lambda r: self.query(*r), requests) ]
+        self.assertEqual(statuses, [200] * 6 + [400, 200, 400, 200, 400, 404])
+
+class HogwildTest(unittest.TestCase):
+
+    def test_settings_and_failures(self):
+        sgns = load_sgns()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            params = make_params(tmpdir, **{'hogwild-workers': 2, 'sparse': True, 'vectorized-pairs': True})
+            ns_table = sgns.make_ns_table(params)
+            gen = sgns.SGNSContextGenerator(ns_table, params)
+            model = sgns.SGNSModel(gen.voc, params)
+            with self.assertRaises(ValueError):
+                sgns.train_hogwild(gen, model, ns_table, dict(params, sparse=False))
+
+            sgns.train_hogwild(gen, model, ns_table, params)
+
+            # If a worker fails, the training fails too.
+            gen = sgns.SGNSContextGenerator(ns_table, dict(params, corpus=os.path.join(tmpdir, 'missing.txt')))
+            with self.assertRaises(RuntimeError):
+                sgns.train_hogwild(gen, model, ns_table, params)
+
+class CheckpointTest(unittest.TestCase):
+
+    def make_trainer(self, sgns, ns_table, params):
+        gen = sgns.SGNSContextGenerator(ns_table, params)
+        model = sgns.SGNSModel(gen.voc, params)
+        return sgns.SGNSTrainer(gen, model, ns_table, params)
+
+    def test_resume_checks(self):
+        sgns = load_sgns()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            params = make_params(tmpdir, **{'checkpoint-file': os.path.join(tmpdir, 'checkpoint.pt'), 'resume': True})
+            ns_table = sgns.make_ns_table(params)
+
+            # A checkpoint in the middle of an epoch, with a byte offset in the text.
+            trainer = self.make_trainer(sgns, ns_table, params)
+            trainer.position = (100, 20, 3)
+            writer = sgns.CheckpointWriter(params['checkpoint-file'])
+            writer.save(trainer.checkpoint_state())
+            writer.wait()
+
+            trainer = self.make_trainer(sgns, ns_table, params)
+            trainer.load_checkpoint(params['checkpoint-file'])
+            self.assertEqual(trainer.position, (100, 20, 3))
+
+            # The encoded corpus uses line numbers, so we can't continue from a byte offset.
+            cached = dict(params, **{'corpus-cache': os.path.join(tmpdir, 'cache')})
+            trainer = self.make_trainer(sgns, ns_table, cached)
+            trainer.load_checkpoint(params['checkpoint-file'])
+            self.assertIsNone(trainer.position)
+
+            trainer = self.make_trainer(sgns, ns_table, dict(params, **{'emb-dim': 4}))
+            with self.assertRaises(ValueError):
+                trainer.load_checkpoint(params['checkpoint-file'])
+
+            # After a finished run, we train again from the beginning.
+            trainer = self.make_trainer(sgns, ns_table, params)
+            trainer.train()
+            trainer = self.make_trainer(sgns, ns_table, params)
+            trainer.load_checkpoint(params['checkpoint-file'])
+            self.assertEqual(trainer.epoch, 0)
+
+class Word2VecFormatTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        sgns = load_sgns()
+        voc = { f'w{i}': i for i in range(1000) }
+        voc['sm\u00f6rg\u00e5s'] = len(voc)
+        model = sgns.SGNSModel(voc, {'emb-dim': 16})
+        expected = model.w.weight.detach().numpy()
+        settings = [ (True, np.float32, 0), (True, np.float16, 2e-3), (False, np.float32, 1e-6) ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'vectors')
+            for binary, dtype, tolerance in settings:
+                sgns.save_word2vec(model, filename, binary, dtype, chunk_size=300)
+                words = []
+                rows = []
+                for chunk_words, chunk in sgns.read_word2vec(filename, binary, dtype, chunk_size=170):
+                    words += chunk_words
+                    rows.append(chunk)
+                self.assertEqual(words, [ model.ivoc[i] for i in range(len(voc)) ])
+                np.testing.assert_allclose(np.concatenate(rows), expected, rtol=0, atol=tolerance)
+
+                # Warm-starting a model with a larger vocabulary copies the vectors of the known words.
+                larger = sgns.SGNSModel(dict(voc, extra=len(voc)), {'emb-dim': 16})
+                sgns.warm_start_model(larger, filename, binary, dtype, chunk_size=170)
+                np.testing.assert_allclose(larger.w.weight.detach().numpy()[:len(voc)], expected, rtol=0, atol=tolerance)
+
+class EmbeddingReaderTest(unittest.TestCase):
+
+    def test_reader_works_without_torch(self):
+        sgns = load_sgns()
+        model = sgns.SGNSModel({ f'w{i}': i for i in range(100) }, {'emb-dim': 8})
+        expected = model.nearest_neighbors(['w1'], 3)[0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'emb')
+            sgns.export_embeddings(model, path)
+            # Importing torch fails in the child process.
+            script = ("import sys; sys.modules['torch'] = None\n"
+                      "from embedding_reader import EmbeddingReader\n"
+                      f"print([ w for w, _ in EmbeddingReader({path!r}).nearest_neighbors(['w1'], 3)[0] ])")
+            output = subprocess.run([sys.executable, '-c', script], cwd=REPO_DIR, check=True,
+                                    capture_output=True, text=True).stdout
+        self.assertEqual(output.strip(), str([ w for w, _ in expected ]))
+
+if __name__ == '__main__':
+    unittest.main()